@@ -0,0 +1,119 @@
+""" Microbenchmarks of portalpy's module-level helpers, each next to the
+straightforward implementation it replaced (the _reference benchmarks), which
+tests/TestHelpers.py checks it gives the same output as.
+
+The benchmarks are written for pytest-benchmark, as functions taking its
+benchmark fixture, and can be run with it (pytest benchmarks/bench_helpers.py)
+or without it, by running this file, which times them with timeit.  Like
+bench_portal.py, it can then --save its results and --compare with the last
+saved ones (in helper_results.json).
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bench_portal
+import portalpy
+
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'helper_results.json')
+
+BASE_URL = 'https://portalpy.esri.com/arcgis/sharing/rest/'
+PAGE_URL = BASE_URL + 'community/users/amy.user?f=json'
+TOKEN = 'dZ0ivCx4S1GHJk-Ab9_pQ7Oh3JZHk8Q6Yp5l3Bv8aKw.'
+
+_connection = portalpy._ArcGISConnection(BASE_URL, lazy=True)
+
+
+def test_normalize_url(benchmark):
+    benchmark(portalpy._normalize_url, BASE_URL)
+
+def test_normalize_url_reference(benchmark):
+    benchmark(portalpy._normalize_url_uncached, BASE_URL)
+
+def test_url_add_token(benchmark):
+    benchmark(_connection._url_add_token, PAGE_URL, TOKEN)
+
+def test_url_add_token_reference(benchmark):
+    benchmark(portalpy._url_with_token, PAGE_URL, TOKEN)
+
+
+class Benchmark(object):
+    """ A stand-in for pytest-benchmark's benchmark fixture, which times the
+    function it's called with (the best of a few timeit runs). """
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.seconds = None
+
+    def __call__(self, func, *args):
+        timer = timeit.Timer(lambda: func(*args))
+        number = 1
+        while timer.timeit(number) < 0.05:
+            number *= 10
+        self.seconds = min(timer.repeat(self.repeat, number)) / number
+        return func(*args)
+
+
+def run(names, repeat):
+    """ Runs the benchmarks, returning their metrics by name. """
+    results = {}
+    for name, func in sorted(globals().items()):
+        if not name.startswith('test_') or names and name[5:] not in names:
+            continue
+        benchmark = Benchmark(repeat)
+        func(benchmark)
+        results[name[5:]] = { 'us': benchmark.seconds * 1000000 }
+
+    # How much faster each helper is than the implementation it replaced
+    for name, metrics in results.items():
+        reference = results.get(name + '_reference')
+        if reference:
+            metrics['speedup'] = reference['us'] / metrics['us']
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks portalpy's "
+                                     'helper functions.')
+    parser.add_argument('benchmarks', nargs='*', help='the benchmarks to run '
+                        '(default: all)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timeit runs, keeping the best (default: 5)')
+    parser.add_argument('--save', action='store_true',
+                        help='append the results to the history file')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the last saved results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='how much worse a metric can get before it is '
+                        'a regression (default: 0.1, for 10%%)')
+    parser.add_argument('--history', default=HISTORY,
+                        help='the history file (default: '
+                        'helper_results.json)')
+    args = parser.parse_args()
+
+    results = run(args.benchmarks, args.repeat)
+    bench_portal.print_results(results)
+
+    status = 0
+    history = bench_portal.load_history(args.history)
+    if args.compare:
+        if not history:
+            print 'No saved results to compare with in ' + args.history
+        else:
+            print '\nCompared with the results saved ' + history[-1]['date']
+            if bench_portal.compare(results, history[-1]['results'],
+                                    args.threshold):
+                status = 1
+    if args.save:
+        bench_portal.save_results(args.history, history, results)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+""" Benchmarks portalpy against a fake portal (tests/fakeportal.py), so they
+can be run anywhere, and compared from one change to the next.
+
+Each case runs its client in a separate process, so peak memory (peak_rss_mb)
+is the client's alone.  The fake portal adds a fixed latency to each request
+(--latency) to stand in for the network.  Results are printed, and with
+--save appended to a history file (results.json); --compare compares the run
+with the last saved one, and exits with status 1 if any metric got worse by
+more than --threshold.
+
+Example - save a baseline, make a change, then check it for regressions
+
+    python benchmarks/bench_portal.py --save
+    python benchmarks/bench_portal.py --compare
+
+Metrics ending in _per_s (throughput), and speedups, are better higher; the
+rest (seconds, milliseconds, megabytes) are better lower.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import fakeportal
+import portalpy
+
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'results.json')
+MB = 1024 * 1024
+
+
+def bench_search(portal, parallel):
+    count = len(portal.search('fake', max_results=5000, parallel=parallel))
+    return count, 'items'
+
+def bench_org_users(portal):
+    return len(portal.get_org_users(max_users=2000)), 'users'
+
+def bench_get_users(portal):
+    names = ['user%05d' % i for i in range(200)]
+    return len(portal.get_users(names, parallel=8)), 'users'
+
+def bench_upload(portal, data, multipart):
+    portal.add_item({ 'title': 'benchmark', 'type': 'Shapefile' },
+                    data=data, multipart=multipart, part_size=8 * MB)
+    return os.path.getsize(data) / float(MB), 'mb'
+
+
+class RandomFile(object):
+    """ A case argument: a file of random data, made before the case is
+    timed, and passed to its client function as the file's path. """
+
+    def __init__(self, size):
+        self.size = size
+
+    def create(self):
+        data = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+        with data:
+            for _ in range(self.size // MB):
+                data.write(os.urandom(MB))
+        return data.name
+
+
+# The cases, as (name, fake portal options, client function, its arguments)
+CASES = [
+    ('search', dict(items=5000), bench_search, (1,)),
+    ('search_parallel', dict(items=5000), bench_search, (4,)),
+    ('search_token_refresh', dict(items=5000, revoke_every=10),
+     bench_search, (1,)),
+    ('org_users', dict(users=2000), bench_org_users, ()),
+    ('get_users', dict(users=200), bench_get_users, ()),
+    ('upload', dict(), bench_upload, (RandomFile(32 * MB), False)),
+    ('upload_multipart', dict(), bench_upload, (RandomFile(64 * MB), True)),
+]
+
+
+def run_client(name, url, username, password):
+    """ Runs one case's client (in a child process), returning its metrics. """
+    ssl._create_default_https_context = ssl._create_unverified_context
+    case = dict((c[0], c) for c in CASES)[name]
+    portal = portalpy.Portal(url, username, password)
+    responses = []
+    portal.add_hook('after_response', lambda info: responses.append(
+        (info['path'], info['timings']['total'])))
+    args = [arg.create() if isinstance(arg, RandomFile) else arg
+            for arg in case[3]]
+    try:
+        start = time.time()
+        count, unit = case[2](portal, *args)
+        seconds = time.time() - start
+    finally:
+        for arg, value in zip(case[3], args):
+            if isinstance(arg, RandomFile):
+                os.remove(value)
+    # ru_maxrss is in kilobytes on Linux, and bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss / float(MB if sys.platform == 'darwin' else 1024)
+    metrics = { 'seconds': seconds, unit + '_per_s': count / seconds,
+                'peak_rss_mb': rss }
+
+    # A token refresh costs the request the portal rejected, and the new
+    # token (the cases that refresh tokens make their requests one by one)
+    refreshes = [i for i, response in enumerate(responses)
+                 if response[0] == 'generateToken' and i > 0]
+    if refreshes:
+        cost = sum(responses[i][1] + responses[i - 1][1] for i in refreshes)
+        metrics['refresh_ms'] = cost * 1000 / len(refreshes)
+    return metrics
+
+def run_case(case, latency):
+    """ Runs a case against a new fake portal, returning its metrics. """
+    name, options = case[0], case[1]
+    fake = fakeportal.FakePortal(latency=latency, **options).start()
+    try:
+        output = subprocess.check_output([sys.executable, __file__,
+                                          '--client', name, fake.url,
+                                          fake.username, fake.password])
+        metrics = json.loads(output)
+        metrics['requests'] = sum(fake.requests.itervalues())
+        if fake.tokens_issued > 1:
+            metrics['token_refreshes'] = fake.tokens_issued - 1
+    finally:
+        fake.stop()
+    return metrics
+
+def run(names, latency, repeat):
+    """ Runs the cases, keeping the best value of each metric from repeat
+    runs of each, as the worst ones are mostly noise. """
+    results = {}
+    for case in CASES:
+        if names and case[0] not in names:
+            continue
+        runs = [run_case(case, latency) for _ in range(repeat)]
+        results[case[0]] = dict((metric, (max if metric.endswith('_per_s')
+                                          else min)(m[metric] for m in runs))
+                                for metric in runs[0])
+    return results
+
+def compare(results, baseline, threshold):
+    """ Prints how results differ from baseline, returning the regressions. """
+    regressions = []
+    for name in sorted(results):
+        for metric in sorted(results[name]):
+            old = baseline.get(name, {}).get(metric)
+            new = results[name][metric]
+            if not old or metric in ('requests', 'token_refreshes'):
+                continue
+            change = (new - old) / float(old)
+            higher = metric.endswith('_per_s') or metric == 'speedup'
+            worse = -change if higher else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric))
+            print '%-22s %-16s %12.3f %12.3f %+7.1f%%%s' \
+                % (name, metric, old, new, change * 100, flag)
+    return regressions
+
+def print_results(results):
+    for name in sorted(results):
+        metrics = ', '.join('%s=%.3f' % (metric, value) for metric, value
+                            in sorted(results[name].iteritems()))
+        print '%-22s %s' % (name, metrics)
+
+def load_history(filepath):
+    if not os.path.exists(filepath):
+        return []
+    with open(filepath) as f:
+        return json.load(f)
+
+def save_results(filepath, history, results, **info):
+    """ Appends results (and info about the run) to the history file. """
+    run = dict(info, date=time.strftime('%Y-%m-%d %H:%M:%S'),
+               python=platform.python_version(),
+               portalpy=portalpy.__version__, results=results)
+    with open(filepath, 'w') as f:
+        json.dump(history + [run], f, indent=2, sort_keys=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks portalpy '
+                                     'against a fake portal.')
+    parser.add_argument('cases', nargs='*', help='the cases to run '
+                        '(default: all of ' + ', '.join(c[0] for c in CASES)
+                        + ')')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='seconds added to each request (default: 0.002)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each case, keeping the best '
+                        '(default: 3)')
+    parser.add_argument('--save', action='store_true',
+                        help='append the results to the history file')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the last saved results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='how much worse a metric can get before it is '
+                        'a regression (default: 0.1, for 10%%)')
+    parser.add_argument('--history', default=HISTORY,
+                        help='the history file (default: results.json)')
+    parser.add_argument('--client', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        print json.dumps(run_client(*args.client))
+        return 0
+
+    results = run(args.cases, args.latency, args.repeat)
+    print_results(results)
+
+    status = 0
+    history = load_history(args.history)
+    if args.compare:
+        if not history:
+            print 'No saved results to compare with in ' + args.history
+        else:
+            print '\nCompared with the results saved ' + history[-1]['date']
+            if compare(results, history[-1]['results'], args.threshold):
+                status = 1
+    if args.save:
+        save_results(args.history, history, results, latency=args.latency)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
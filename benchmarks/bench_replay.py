@@ -0,0 +1,225 @@
+""" Records a portalpy session, then replays it without a network, to time
+(and profile) what the client itself spends time on: decoding, paging, URLs,
+tokens, multipart encoding and so on.
+
+Example - record a session against a fake portal, then profile its replay
+
+    python benchmarks/bench_replay.py record session.json.gz
+    python benchmarks/bench_replay.py replay session.json.gz --profile
+
+Without --url, sessions are recorded against a fake portal
+(tests/fakeportal.py).  A session is made by one of the scenarios here, or by
+the run(portal) function of a --script; replay it with the same one.  Like
+bench_portal.py, replay can --save its results and --compare with the last
+saved ones (in replay_results.json).
+"""
+
+import argparse
+import cProfile
+import os
+import pstats
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import bench_portal
+import fakeportal
+import portalpy
+
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'replay_results.json')
+UPLOAD_SIZE = 16 * 1024 * 1024
+
+
+def read_scenario(portal, upload):
+    portal.logged_in_user()
+    portal.search('fake', max_results=2000)
+    users = portal.get_org_users(max_users=500)
+    portal.get_users([user['username'] for user in users[:50]], parallel=4)
+    for group in portal.search_groups('', max_groups=20):
+        portal.get_group_members(group['id'])
+
+def upload_scenario(portal, upload):
+    portal.add_item({ 'title': 'benchmark', 'type': 'Shapefile' },
+                    data=upload, multipart=True, part_size=8 * 1024 * 1024)
+    portal.add_item({ 'title': 'benchmark', 'type': 'Shapefile' },
+                    data=upload)
+
+SCENARIOS = { 'read': read_scenario, 'upload': upload_scenario }
+
+
+def load_scenario(args):
+    if args.script:
+        namespace = {}
+        execfile(args.script, namespace)
+        return lambda portal, upload: namespace['run'](portal)
+    return SCENARIOS[args.scenario]
+
+def make_upload():
+    """ Returns the path of a file to upload, with the same name and size
+    every time, so the requests that upload it match the recorded ones. """
+    upload = os.path.join(tempfile.mkdtemp(), 'benchmark.zip')
+    with open(upload, 'wb') as f:
+        for _ in range(UPLOAD_SIZE // (1024 * 1024)):
+            f.write(os.urandom(1024 * 1024))
+    return upload
+
+def remove_upload(upload):
+    os.remove(upload)
+    os.rmdir(os.path.dirname(upload))
+
+def record(args):
+    scenario = load_scenario(args)
+    fake = None
+    url, username, password = args.url, args.username, args.password
+    if not url:
+        ssl._create_default_https_context = ssl._create_unverified_context
+        fake = fakeportal.FakePortal(users=1000, items=5000,
+                                     latency=args.latency).start()
+        url, username, password = fake.url, fake.username, fake.password
+    upload = make_upload()
+    try:
+        with portalpy.RecordingTransport(args.session) as recorder:
+            portal = portalpy.Portal(url, username, password,
+                                     transport=recorder)
+            started = time.time()
+            scenario(portal, upload)
+            print 'Recorded %s in %.3f seconds' % (args.session,
+                                                   time.time() - started)
+    finally:
+        remove_upload(upload)
+        if fake:
+            fake.stop()
+    return 0
+
+def session_info(replayer):
+    """ Returns the portal URL and username a session was recorded with. """
+    url, username = None, None
+    for record in replayer.interactions:
+        if '/sharing/rest' in record['url'] and not url:
+            url = record['url'].split('/sharing/rest')[0]
+        if record['url'].split('?')[0].endswith('/generateToken'):
+            username = dict(urlparse.parse_qsl(record['body'])) \
+                .get('username')
+            break
+    return url, username
+
+def replay_once(args, scenario, upload, profiles):
+    replayer = portalpy.ReplayTransport(args.session, args.strict,
+                                        args.speed)
+    url, username = session_info(replayer)
+    if profiles is not None:
+        threading.setprofile(_profile_thread(profiles))
+        profiles.append(cProfile.Profile())
+        profiles[-1].enable()
+    started = time.time()
+    try:
+        portal = portalpy.Portal(url, username, 'replayed',
+                                 transport=replayer)
+        scenario(portal, upload)
+    finally:
+        seconds = time.time() - started
+        if profiles is not None:
+            profiles[0].disable()
+            threading.setprofile(None)
+    return { 'seconds': seconds, 'requests_per_s': replayer.replayed / seconds,
+             'missed': replayer.missed }
+
+def _profile_thread(profiles):
+    """ Returns a profile function that starts a profiler in each new thread
+    (the pools' worker threads, and background pages). """
+    def start(frame, event, arg):
+        profiler = cProfile.Profile()
+        profiles.append(profiler)
+        profiler.enable()
+    return start
+
+def replay(args):
+    scenario = load_scenario(args)
+    upload = make_upload()
+    try:
+        runs = []
+        for _ in range(args.repeat):
+            profiles = [] if args.profile and not runs else None
+            runs.append(replay_once(args, scenario, upload, profiles))
+            if profiles:
+                stats = pstats.Stats(*profiles)
+                stats.sort_stats('cumulative').print_stats('portalpy', 25)
+    finally:
+        remove_upload(upload)
+
+    # Keep the best of each metric, as in bench_portal.py
+    name = os.path.basename(args.script) if args.script else args.scenario
+    results = { name: { 'seconds': min(r['seconds'] for r in runs),
+                        'requests_per_s': max(r['requests_per_s']
+                                              for r in runs),
+                        'missed': runs[-1]['missed'] } }
+    bench_portal.print_results(results)
+
+    status = 0
+    history = bench_portal.load_history(args.history)
+    if args.compare:
+        if not history:
+            print 'No saved results to compare with in ' + args.history
+        else:
+            print '\nCompared with the results saved ' + history[-1]['date']
+            if bench_portal.compare(results, history[-1]['results'],
+                                    args.threshold):
+                status = 1
+    if args.save:
+        bench_portal.save_results(args.history, history, results,
+                                  session=os.path.basename(args.session))
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description='Records and replays '
+                                     'portalpy sessions.')
+    parser.add_argument('command', choices=['record', 'replay'])
+    parser.add_argument('session', help='the session file')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS),
+                        default='read', help='what the session does '
+                        '(default: read)')
+    parser.add_argument('--script', help='a Python file whose run(portal) '
+                        'function makes the session, instead of a scenario')
+    parser.add_argument('--url', help='record against this portal, instead '
+                        'of a fake one')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help="the fake portal's latency, in seconds "
+                        '(default: 0.002)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='replays, keeping the best (default: 5)')
+    parser.add_argument('--speed', type=float,
+                        help='replay at this multiple of the recorded pace '
+                        '(default: as fast as possible)')
+    parser.add_argument('--strict', action='store_true',
+                        help='fail on requests that were not recorded')
+    parser.add_argument('--profile', action='store_true',
+                        help='print a profile of the first replay')
+    parser.add_argument('--save', action='store_true',
+                        help='append the results to the history file')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the last saved results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='how much worse a metric can get before it is '
+                        'a regression (default: 0.1, for 10%%)')
+    parser.add_argument('--history', default=HISTORY,
+                        help='the history file (default: '
+                        'replay_results.json)')
+    args = parser.parse_args()
+    if args.command == 'record':
+        return record(args)
+    return replay(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -31,7 +31,7 @@ portalAdminPassword = "portaladmin"
     
 portal = portalpy.Portal(portalUrl, portalAdminUser, portalAdminPassword)
 users = portal.search_users('(role:account_admin OR role:account_publisher)')
+users = portal.get_users(users, fields=['username', 'role'])
 
 for user in users :
-    userResp = portal.get_user(user['username'])
-    print user['username'] + ":  " + userResp['role']
+    print user['username'] + ":  " + user['role']
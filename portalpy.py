@@ -2,28 +2,127 @@
 
 __version__ = '1.0'
 
+import base64
+import bisect
 import collections
+import contextlib
 import copy
-import gzip
+import hashlib
 import httplib
-import imghdr
+import importlib
+import itertools
 import json
 import logging
-import mimetools
-import mimetypes
 import os
+import Queue
+import random
 import re
-import tempfile
+import socket
+import sys
+import threading
+import time
 import unicodedata
 import urllib
 import urllib2
 import urlparse
+import zlib
 from cStringIO import StringIO
 
+# The module responses are decoded with (see set_json_backend)
+_json_backend = json
+
 
 
 _log = logging.getLogger(__name__)
 
+# The block size used when streaming request and response bodies
+_CHUNK_SIZE = 64 * 1024
+
+# Multipart item uploads: part size limits, and how often a part is retried
+_MIN_PART_SIZE = 5 * 1024 * 1024
+_MAX_PARTS = 10000
+_PART_RETRIES = 3
+
+# How long to wait for the portal to assemble a committed multipart upload,
+# and the longest wait between checks of its status (in seconds)
+_COMMIT_TIMEOUT = 3600
+_COMMIT_POLL_MAX = 10
+
+# The most results the portal returns for a single search query
+_SEARCH_RESULT_LIMIT = 10000
+
+# Tokens are renewed this many seconds before they expire (or after 90% of
+# their lifetime, for short-lived tokens)
+_TOKEN_RENEW_MARGIN = 60
+
+# Tokens are kept for at least this many seconds before being renewed (a
+# portal whose clock is behind ours looks like it issues tokens that have
+# already expired), and a failed renewal is retried after a delay that
+# doubles up to the maximum (the old token is used until then)
+_TOKEN_MIN_LIFETIME = 5
+_TOKEN_RETRY_MAX = 60
+
+# What httplib's BadStatusLine holds when the connection was closed before
+# the status line (different Python 2.7 releases say it differently)
+_NO_STATUS_LINES = frozenset(['', "''", 'No status line received - the '
+                              'server has closed the connection'])
+
+# Operations (the last part of the REST path) that change the portal. POSTs
+# to them aren't retried after a transient failure, as the first attempt
+# may already have been applied.
+_WRITE_OPERATIONS = frozenset([
+    'additem', 'addpart', 'addusers', 'commit', 'createfolder',
+    'creategroup', 'delete', 'deleteitems', 'invite', 'join', 'leave',
+    'move', 'reassign', 'removeusers', 'reset', 'share', 'signup',
+    'unshare', 'update', 'updateuserrole'])
+
+# Operations that upload content, and paths (relative to the REST root) that
+# search or list, for sorting requests into rate limiter classes
+_UPLOAD_OPERATIONS = frozenset(['additem', 'addpart', 'commit'])
+_SEARCH_PATHS = ('/search', '/community/users', '/community/groups',
+                 '/portals/self/users')
+
+# Upper bounds (in seconds) of the request latency histogram's buckets
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The Prometheus counters written for each REST path: name, stats key, help
+_PROMETHEUS_COUNTERS = [
+    ('requests_total', 'count', 'Requests made.'),
+    ('request_errors_total', 'errors', 'Requests that failed.'),
+    ('request_retries_total', 'retries', 'Retried attempts.'),
+    ('token_relogins_total', 'relogins',
+     'Logins after a 498 (invalid token) response.'),
+    ('request_bytes_total', 'bytes_sent', 'Request body bytes.'),
+    ('response_bytes_total', 'bytes_received',
+     'Response body bytes, as sent (maybe compressed).'),
+    ('response_decoded_bytes_total', 'bytes_decoded',
+     'Response body bytes, decompressed.')]
+
+# The events a connection calls hooks for
+_HOOK_EVENTS = ('before_request', 'after_response', 'on_error')
+
+# The phases of a request, in order, timed when hooks are registered
+_PHASES = ('connect', 'tls', 'send', 'first_byte', 'receive', 'decode')
+
+# The most characters of a response body written to the debug log
+_LOG_BODY_LIMIT = 1000
+
+# Parameters whose values are redacted from recorded sessions (see
+# RecordingTransport), and which, like the referer, are ignored when matching
+# a request to a recorded one
+_SECRET_PARAMS = ('token', 'password', 'access_token', 'refresh_token')
+_UNMATCHED_PARAMS = frozenset(_SECRET_PARAMS + ('referer',))
+_SECRET_PARAM_RE = re.compile(r'((?:^|[?&])(?:' + '|'.join(_SECRET_PARAMS)
+                              + r')=)[^&#"\s]*')
+_SECRET_JSON_RE = re.compile(r'("(?:' + '|'.join(_SECRET_PARAMS)
+                             + r')"\s*:\s*")[^"]*')
+_REDACTED = 'REDACTED'
+
+# The most URLs the URL helpers remember the results for (their caches are
+# cleared when full), and the token that token URL templates are built with
+_URL_CACHE_SIZE = 1000
+_TOKEN_PLACEHOLDER = 'PORTALPYTOKENPLACEHOLDER'
+
 class Portal(object):
     """ An object representing a connection to a single portal (via URL).
     
@@ -38,6 +137,13 @@ class Portal(object):
         a group id, use the search_groups function using the title
         to get the group id.
                 
+        Threads - A Portal can be shared by many threads, once it has been
+        constructed.  Requests share a pool of connections, and when the
+        token needs renewing only one thread logs in again while the
+        others wait for its new token.  Dicts returned by the methods
+        belong to the caller.  Calling login or logout while other threads
+        are making requests is not supported.
+
         Time - Many of the methods return a time field.  All time is
         returned as millseconds since 1 January 1970.  Python
         expects time in seconds since 1 January 1970 so make sure
@@ -84,8 +190,45 @@ class Portal(object):
 
     def __init__(self, url, username=None, password=None, key_file=None,
                  cert_file=None, expiration=60, referer=None, proxy_host=None,
-                 proxy_port=None, connection=None, workdir=tempfile.gettempdir()):
-        """ The Portal constructor. Requires URL and optionally username/password."""
+                 proxy_port=None, connection=None, workdir=None,
+                 pool_size=10, pool_idle_timeout=60, bootstrap_cache=False,
+                 bootstrap_ttl=3600, lazy=False, retry_policy=None,
+                 rate_limiter=None, coalesce=False, transport=None,
+                 timeout=None):
+        """ The Portal constructor. Requires URL and optionally username/password.
+
+        With bootstrap_cache=True, the portal version and properties and the
+        logged in user are saved in the workdir.  For bootstrap_ttl seconds
+        after that, constructing a Portal for the same URL and user uses the
+        saved values (and logs in on the first request) instead of asking
+        the portal, and then refreshes them in the background.
+
+        With lazy=True, the constructor makes no requests at all.  The login,
+        version, properties and logged in user are fetched when first needed.
+        The workdir defaults to the system's temporary directory.
+
+        Requests that fail for a transient reason (429, 502, 503 or 504
+        responses, timeouts, dropped connections) are retried as described
+        by retry_policy, which defaults to RetryPolicy().  A request times
+        out if the portal sends nothing for timeout seconds (by default, it
+        waits as long as the socket module's default timeout).  Requests go
+        through proxy_host:proxy_port if given, or else through the proxies
+        in the http_proxy and https_proxy environment variables (except for
+        the hosts in no_proxy).  To keep many
+        threads from overloading the portal, pass a RateLimiter as
+        rate_limiter.  With coalesce=True, a read made while an identical
+        one is in flight (from another thread) waits for that one's response
+        rather than sending its own request, and gets a copy of it.
+
+        Requests are sent by the transport, a pool of keep-alive connections
+        by default.  To record the requests and responses of a session to a
+        file, pass a RecordingTransport as transport; to play one back
+        without a network, pass a ReplayTransport.  Any object with their
+        urlopen(method, url, body, headers, redirects, timings) method can
+        be a transport: it returns a response with status, reason, msg,
+        info(), getheader(), read() and close() (and bytes_received and
+        bytes_decoded counters), and raises urllib2.HTTPError for error
+        statuses."""
         
         self.url = url
         if url:
@@ -107,6 +250,17 @@ class Portal(object):
         self._is_pre_162 = False
         self._is_pre_21 = False
 
+        # Try to start from the bootstrap cache, if there's a fresh one
+        self._bootstrap_file = None
+        cached = False
+        if bootstrap_cache and url:
+            key = hashlib.sha1(_utf8(self.resturl + '|' + (username or ''))) \
+                .hexdigest()
+            self._bootstrap_file = os.path.join(self._get_workdir(),
+                                                'portalpy-bootstrap-'
+                                                + key + '.json')
+            cached = self._load_bootstrap(bootstrap_ttl)
+
         # If a connection was passed in, use it, otherwise setup the
         # connection (use all SSL until portal informs us otherwise)
         if connection:
@@ -118,14 +272,26 @@ class Portal(object):
 
             self.con = _ArcGISConnection(self.resturl, username, password,
                                         key_file, cert_file, expiration, True,
-                                        referer, proxy_host, proxy_port)
-
-        # Store the logged in user information. It's useful.
-        if self.is_logged_in():
-            self._logged_in_user = self.get_user(username)
-
-        self.get_version(True)
-        self.get_properties(True)
+                                        referer, proxy_host, proxy_port,
+                                        pool_size=pool_size,
+                                        pool_idle_timeout=pool_idle_timeout,
+                                        lazy=cached or lazy,
+                                        retry_policy=retry_policy,
+                                        rate_limiter=rate_limiter,
+                                        coalesce=coalesce,
+                                        transport=transport,
+                                        timeout=timeout)
+
+        # The logged in user from the bootstrap cache is only kept if the
+        # login (deferred to the first request) works
+        self._cached_login = cached and bool(username)
+        if cached:
+            self.con.all_ssl = self.is_all_ssl()
+            if not lazy:
+                self._refresh = _BackgroundCall(self._refresh_bootstrap,
+                                                username)
+        elif not lazy:
+            self._bootstrap(username)
 
 
 
@@ -151,6 +317,7 @@ class Portal(object):
         """
 
 
+        self.get_version()
         if self._is_pre_21:
             _log.warning('The auto_accept option is not supported in ' \
                          + 'pre-2.0 portals')
@@ -165,7 +332,36 @@ class Portal(object):
         return resp
     
 
-    def add_item(self, item_properties, data=None, thumbnail=None, metadata=None, owner=None, folder=None):
+    def add_hook(self, event, hook):
+        """ Adds a function to be called around each request, for profiling
+        or tracing.  Hooks cost nothing until one is added.
+
+        .. note::
+            Hooks are called with a dict describing the request: method,
+            url (without the query string), path (the REST path template,
+            like 'community/users/{user}'), start (time.time() when it
+            began), status, retries, bytes_sent, bytes_received (as sent,
+            maybe compressed) and bytes_decoded, and timings, a dict of
+            seconds spent in each phase of the last attempt: connect, tls,
+            send, first_byte (waiting for the response), receive, decode
+            (parsing the JSON) and total (including retries).  Only the
+            first few are known before the request.
+
+        ================  ========================================================
+        **Argument**      **Description**
+        ----------------  --------------------------------------------------------
+        event             required string, when to call the hook:
+                          'before_request', 'after_response' or 'on_error'
+        ----------------  --------------------------------------------------------
+        hook              required function, called with the dict (and for
+                          on_error, the exception as well)
+        ================  ========================================================
+        """
+        self.con.add_hook(event, hook)
+
+
+    def add_item(self, item_properties, data=None, thumbnail=None, metadata=None, owner=None, folder=None,
+                 multipart=False, part_size=32 * 1024 * 1024, parallel=4):
         """ Adds content to a Portal.  
 	
         
@@ -177,6 +373,11 @@ class Portal(object):
             If you are uploading a package or other file, provide a path or URL
             to the file in the data argument.
 
+            Large files can be uploaded with multipart=True.  The file is then
+            sent in parts, several at a time, and failed parts are retried on
+            their own.  Progress is saved in the workdir, so calling add_item
+            again with the same file after a crash resumes the upload.
+
             From a technical perspective, none of the item properties below are required.  However,
             it is strongly recommended that title, type, typeKeywords, tags, snippet, and description
             be provided.
@@ -196,6 +397,12 @@ class Portal(object):
         owner            optional string, defaults to logged in user.
         ------------     ----------------------------------------------------
         folder           optional string, content folder where placing item
+        ------------     ----------------------------------------------------
+        multipart        optional boolean, upload data in parts (large files)
+        ------------     ----------------------------------------------------
+        part_size        optional int, size in bytes of each multipart part
+        ------------     ----------------------------------------------------
+        parallel         optional int, number of parts uploaded at once
         ============     ====================================================
 
 
@@ -260,6 +467,7 @@ class Portal(object):
                 thumbnail = urllib.urlretrieve(thumbnail)[0]
                 file_ext = os.path.splitext(thumbnail)[1]
                 if not file_ext:
+                    import imghdr
                     file_ext = imghdr.what(thumbnail)
                     if file_ext in ('gif', 'png', 'jpeg'):
                         new_thumbnail = thumbnail + '.' + file_ext
@@ -276,6 +484,9 @@ class Portal(object):
         if folder:
             path += '/' + folder
         path += '/addItem'
+        if multipart and data:
+            return self._add_item_multipart(path, owner, postdata, files,
+                                            part_size, parallel)
         resp = self.con.post(path, postdata, files)
         if resp and resp.get('success'):
             return resp['id']
@@ -317,6 +528,7 @@ class Portal(object):
                 thumbnail = urllib.urlretrieve(thumbnail)[0]
                 file_ext = os.path.splitext(thumbnail)[1]
                 if not file_ext:
+                    import imghdr
                     file_ext = imghdr.what(thumbnail)
                     if file_ext in ('gif', 'png', 'jpeg'):
                         new_thumbnail = thumbnail + '.' + file_ext
@@ -645,11 +857,13 @@ class Portal(object):
                              self._postdata())
 
 
-    def get_org_users(self, max_users=1000):
+    def get_org_users(self, max_users=1000, parallel=1, fields=None):
         """ Returns all users within the portal organization. 
              
         Arguments
             max_users : optional int, the maximum number of users to return.
+            parallel :  optional int, the number of pages fetched at once.
+            fields :    optional list of strings, the keys to keep in each user.
             
         :return:
             a list of dicts.  Each dict has the following keys:
@@ -702,38 +916,37 @@ class Portal(object):
        
         """
 
+        return list(self.iter_org_users(max_users, parallel, fields))
+
+
+    def iter_org_users(self, max_users=1000, parallel=1, fields=None):
+        """ Same as get_org_users, but returns an iterator that yields users
+        page by page while the next page is fetched in the background. """
+
         # Execute the search and get back the results
-        count = 0
-        resp = self._org_users_page(1, min(max_users, 100))
-        resp_users = resp.get('users')
-        results = resp_users
-        count += int(resp['num'])
-        nextstart = int(resp['nextStart'])
-        while count < max_users and nextstart > 0:
-            resp = self._org_users_page(nextstart, min(max_users - count, 100))
-            resp_users = resp.get('users')
-            results.extend(resp_users)
-            count += int(resp['num'])
-            nextstart = int(resp['nextStart'])
- 
-        return results
+        return self._iter_pages(self._org_users_page, 'users', max_users,
+                                parallel, fields, limit=None)
 
 
 
     def get_properties(self, force=False):
-        """ Returns the portal properties (using cache unless force=True). """
+        """ Returns the portal properties (using cache unless force=True).
+
+        The properties are a copy, so changing them doesn't change the
+        cached ones. """
 
         # If we've never retrieved the properties before, or the caller is
         # forcing a check of the server, then check the server
         if not self._properties or force:
+            self.get_version()
             path = 'accounts/self' if self._is_pre_162 else 'portals/self'
             resp = self.con.post(path, self._postdata(), ssl=True)
             if resp:
                 self._properties = resp
                 self.con.all_ssl = self.is_all_ssl()
 
-        # Return a defensive copy
-        return copy.deepcopy(self._properties)
+        # Return a defensive copy (None if there are no properties)
+        return _copy_json(self._properties)
 
     def get_user(self, username):
         """ Returns the user information for the specified username. 
@@ -788,6 +1001,61 @@ class Portal(object):
         return self.con.post('community/users/' + username, self._postdata())
 
 
+    def get_users(self, usernames, fields=None, parallel=8):
+        """ Returns the user information for several users at once.
+
+        .. note::
+            Administrators get the users from the organization's user list,
+            a page of 100 users at a time, when that takes fewer requests
+            than looking up each user.  Otherwise the users are looked up
+            individually, several at a time.
+
+        ================  ========================================================
+        **Argument**      **Description**
+        ----------------  --------------------------------------------------------
+        usernames         required list of usernames (or of dicts with a username
+                          key, like those returned by search_users)
+        ----------------  --------------------------------------------------------
+        fields            optional list of strings, the keys to keep in each user
+        ----------------  --------------------------------------------------------
+        parallel          optional int, number of requests made at once
+        ================  ========================================================
+
+        :return:
+            a list of user dictionaries (see get_user) in the same order as
+            usernames, with None for users that weren't found.
+        """
+
+        usernames = _unpack(usernames, 'username') or []
+        found = {}
+        if fields and 'username' not in fields:
+            fields = list(fields) + ['username']
+
+        # Page through the org's users if that's fewer requests
+        user = self.logged_in_user()
+        if user and user.get('role') in ('org_admin', 'account_admin'):
+            total = int(self._org_users_page(1, 1)['total'])
+            if -(-total // 100) < len(usernames):
+                wanted = set(name.lower() for name in usernames)
+                for org_user in self.iter_org_users(total, parallel, fields):
+                    name = org_user['username'].lower()
+                    if name in wanted:
+                        found[name] = org_user
+                        wanted.discard(name)
+                        if not wanted:
+                            break
+                return [found.get(name.lower()) for name in usernames]
+
+        # Otherwise look each user up
+        unique = list(set(usernames))
+        for name, org_user in zip(unique, _parallel_map(self.get_user, unique,
+                                                        parallel)):
+            if org_user and fields:
+                org_user = self._extract([org_user], fields)[0]
+            found[name] = org_user
+        return [found[name] for name in usernames]
+
+
 
 
 
@@ -851,20 +1119,20 @@ class Portal(object):
 
     def is_multitenant(self):
         """ Returns true if this portal is multitenant. """
-        return self._properties['portalMode'] == 'multitenant'
+        return self.get_properties()['portalMode'] == 'multitenant'
 
     def is_arcgisonline(self):
         """ Returns true if this portal is ArcGIS Online. """
-        return self._properties['portalName'] == 'ArcGIS Online' \
+        return self.get_properties()['portalName'] == 'ArcGIS Online' \
             and self.is_multitenant()
 
     def is_subscription(self):
         """ Returns true if this portal is an ArcGIS Online subscription. """
-        return bool(self._properties.get('urlKey'))
+        return bool(self.get_properties().get('urlKey'))
 
     def is_org(self):
         """ Returns true if this portal is an organization. """
-        return bool(self._properties.get('id'))
+        return bool(self.get_properties().get('id'))
 
 
     def leave_group(self, group_id):
@@ -955,11 +1223,21 @@ class Portal(object):
             ----------------  --------------------------------------------------------
             idpUsername       string, name of the user in their identity provider
             ================  ========================================================
+
+            The dict is a copy, so changing it doesn't change the cached one.
          
          """
+        # Lazy portals look the user up when it's first needed, and a user
+        # from the bootstrap cache is dropped if the login fails
+        if self._cached_login:
+            self._cached_login = False
+            if not self.con._current_token():
+                self._logged_in_user = None
+        if not self._logged_in_user and self.con._current_token():
+            self._logged_in_user = self.get_user(self.con._username)
         if self._logged_in_user:
             # Return a defensive copy
-            return copy.deepcopy(self._logged_in_user)
+            return _copy_json(self._logged_in_user)
         return None
 
 
@@ -1128,34 +1406,142 @@ class Portal(object):
         return resp
 
 
+    def remove_hook(self, event, hook):
+        """ Removes a function added with add_hook. """
+        self.con.remove_hook(event, hook)
+
+
     def search(self, q, bbox=None, sort_field='title', sort_order='asc', 
-               max_results=1000, add_org=True):
+               max_results=1000, add_org=True, parallel=1, fields=None):
+
+        return list(self.iter_search(q, bbox, sort_field, sort_order,
+                                     max_results, add_org, parallel, fields))
+
 
+    def iter_search(self, q, bbox=None, sort_field='title', sort_order='asc',
+                    max_results=1000, add_org=True, parallel=1, fields=None):
+        """ Same as search, but returns an iterator that yields items page by
+        page while the next page is fetched in the background. """
 
         if add_org:
-            accountid = self._properties.get('id')
+            accountid = self.get_properties().get('id')
             if accountid and q:
                 q += ' accountid:' + accountid
             elif accountid:
                 q = 'accountid:' + accountid
  
-        count = 0
-        resp = self._search_page(q, bbox, 1, min(max_results, 100), sort_field, sort_order)
-        results = resp.get('results')
-        count += int(resp['num'])
-        nextstart = int(resp['nextStart'])
-        while count < max_results and nextstart > 0:
-            resp = self._search_page(q, bbox, nextstart, min(max_results - count, 100),
-                               sort_field, sort_order)
-            results.extend(resp['results'])
-            count += int(resp['num'])
-            nextstart = int(resp['nextStart'])
-   
+        def page(start, num):
+            return self._search_page(q, bbox, start, num, sort_field, sort_order)
+        return self._iter_pages(page, 'results', max_results, parallel,
+                                fields)
+
+
+    def search_sharded(self, q, bbox=None, sort_field='created',
+                       sort_order='asc', add_org=True, parallel=4, fields=None,
+                       start_date=0, end_date=None):
+        """ Searches for items without the portal's limit of 10,000 results
+        per query.
+
+        .. note::
+            The query is split into ranges of creation dates (in ms since
+            1 Jan 1970).  Any range with more than 10,000 results is split
+            in half until every range is under the limit, then the ranges
+            are searched at the same time.  A range can't be split past a
+            single millisecond, so if more than 10,000 items were created in
+            the same millisecond, only 10,000 of them are returned (and a
+            warning is logged).  Results are merged in order of
+            creation date, and duplicates (items that turned up in two
+            ranges) are dropped, so results always include the id.  When
+            sorting by anything other than created, results are only sorted
+            within each date range.
+
+        ================  ========================================================
+        **Argument**      **Description**
+        ----------------  --------------------------------------------------------
+        q                 required string, query string.  See search_users.
+        ----------------  --------------------------------------------------------
+        bbox              optional string, bounding box to search within
+        ----------------  --------------------------------------------------------
+        sort_field        optional string, field results are sorted by
+        ----------------  --------------------------------------------------------
+        sort_order        optional string, valid values are asc or desc
+        ----------------  --------------------------------------------------------
+        add_org           optional boolean, controls whether to search within your org
+        ----------------  --------------------------------------------------------
+        parallel          optional int, number of date ranges searched at once
+        ----------------  --------------------------------------------------------
+        fields            optional list of strings, the keys to keep in each result
+        ----------------  --------------------------------------------------------
+        start_date        optional int, earliest creation date, defaults to 0
+        ----------------  --------------------------------------------------------
+        end_date          optional int, latest creation date, defaults to now
+        ================  ========================================================
+
+        :return:
+            a list of item dictionaries, see search.
+        """
+
+        if add_org:
+            accountid = self.get_properties().get('id')
+            if accountid and q:
+                q = '(' + q + ') AND accountid:' + accountid
+            elif accountid:
+                q = 'accountid:' + accountid
+        if end_date is None:
+            end_date = int(time.time() * 1000)
+
+        def range_query(date_range):
+            created = 'created:[%019d TO %019d]' % date_range
+            return '(' + q + ') AND ' + created if q else created
+
+        def range_total(date_range):
+            resp = self._search_page(range_query(date_range), bbox, 1, 1)
+            return int(resp['total'])
+
+        # Split the date ranges until each has fewer results than the limit
+        shards = []
+        ranges = [(start_date, end_date)]
+        while ranges:
+            totals = _parallel_map(range_total, ranges, parallel)
+            split_ranges = []
+            for (lo, hi), total in zip(ranges, totals):
+                if total > _SEARCH_RESULT_LIMIT and hi > lo:
+                    mid = (lo + hi) // 2
+                    split_ranges.extend([(lo, mid), (mid + 1, hi)])
+                elif total:
+                    if total > _SEARCH_RESULT_LIMIT:
+                        _log.warning('%d items were created at %d, only the '
+                                     'first %d are returned', total, lo,
+                                     _SEARCH_RESULT_LIMIT)
+                    shards.append((lo, hi))
+            ranges = split_ranges
+        shards.sort(reverse=(sort_order == 'desc'))
+
+        # Search each range, then merge them (dropping any duplicates)
+        # Results need their ids to drop duplicates
+        if fields and 'id' not in fields:
+            fields = list(fields) + ['id']
+
+        def search_shard(date_range):
+            def page(start, num):
+                return self._search_page(range_query(date_range), bbox, start,
+                                         num, sort_field, sort_order)
+            return list(self._iter_pages(page, 'results', _SEARCH_RESULT_LIMIT,
+                                         1, fields))
+
+        results = []
+        seen = set()
+        for shard_results in _parallel_map(search_shard, shards, parallel):
+            for result in shard_results:
+                item_id = result.get('id')
+                if item_id is None or item_id not in seen:
+                    seen.add(item_id)
+                    results.append(result)
         return results
 
 
     def search_groups(self, q, sort_field='title',sort_order='asc', 
-                      max_groups=1000, add_org=True):
+                      max_groups=1000, add_org=True, parallel=1, fields=None):
         """ Searches for portal groups.
         
         .. note:: 
@@ -1185,6 +1571,10 @@ class Portal(object):
         max_groups        optional int, maximum number of groups returned
         ----------------  --------------------------------------------------------
         add_org           optional boolean, controls whether to search within your org
+        ----------------  --------------------------------------------------------
+        parallel          optional int, number of result pages fetched at once
+        ----------------  --------------------------------------------------------
+        fields            optional list of strings, the keys to keep in each result
         ================  ========================================================
 
         :return:
@@ -1224,34 +1614,36 @@ class Portal(object):
             title             string, name of group as shown to users
             ================  ========================================================
         """
-        
+
+        return list(self.iter_search_groups(q, sort_field, sort_order,
+                                            max_groups, add_org, parallel,
+                                            fields))
+
+
+    def iter_search_groups(self, q, sort_field='title', sort_order='asc',
+                           max_groups=1000, add_org=True, parallel=1,
+                           fields=None):
+        """ Same as search_groups, but returns an iterator that yields groups
+        page by page while the next page is fetched in the background. """
+
         if add_org:
-            accountid = self._properties.get('id')
+            accountid = self.get_properties().get('id')
             if accountid and q:
                 q += ' accountid:' + accountid
             elif accountid:
                 q = 'accountid:' + accountid
         
         # Execute the search and get back the results
-        count = 0
-        resp = self._groups_page(q, 1, min(max_groups,100), sort_field, sort_order) 
-        results = resp.get('results')
-        count += int(resp['num'])
-        nextstart = int(resp['nextStart'])
-        while count < max_groups and nextstart > 0:
-            resp = self._groups_page(q, 1, min(max_groups - count,100), 
-                                     sort_field, sort_order)
-            resp_users = resp.get('results')
-            results.extend(resp_users)
-            count += int(resp['num'])
-            nextstart = int(resp['nextStart'])
-
-        return results
+        def page(start, num):
+            return self._groups_page(q, start, num, sort_field, sort_order)
+        return self._iter_pages(page, 'results', max_groups, parallel,
+                                fields)
         
        
  
     def search_users(self, q, sort_field='username',
-              sort_order='asc', max_users=1000, add_org=True):
+              sort_order='asc', max_users=1000, add_org=True, parallel=1,
+              fields=None):
         """ Searches portal users. 
         
         This gives you a list of users and some basic information
@@ -1287,6 +1679,10 @@ class Portal(object):
         max_users         optional int, maximum number of users returned
         ----------------  --------------------------------------------------------
         add_org           optional boolean, controls whether to search within your org
+        ----------------  --------------------------------------------------------
+        parallel          optional int, number of result pages fetched at once
+        ----------------  --------------------------------------------------------
+        fields            optional list of strings, the keys to keep in each result
         ================  ========================================================
 
         :return:
@@ -1315,28 +1711,29 @@ class Portal(object):
             ================  ========================================================
         """
 
+        return list(self.iter_search_users(q, sort_field, sort_order,
+                                           max_users, add_org, parallel,
+                                           fields))
+
+
+    def iter_search_users(self, q, sort_field='username', sort_order='asc',
+                          max_users=1000, add_org=True, parallel=1,
+                          fields=None):
+        """ Same as search_users, but returns an iterator that yields users
+        page by page while the next page is fetched in the background. """
+
         if add_org:
-            accountid = self._properties.get('id')
+            accountid = self.get_properties().get('id')
             if accountid and q:
                 q += ' accountid:' + accountid
             elif accountid:
                 q = 'accountid:' + accountid
 
         # Execute the search and get back the results
-        count = 0
-        resp = self._users_page(q, 1, min(max_users, 100), sort_field, sort_order)
-        results = resp.get('results')
-        count += int(resp['num'])
-        nextstart = int(resp['nextStart'])
-        while count < max_users and nextstart > 0:
-            resp = self._users_page(q, nextstart, min(max_users - count, 100),
-                                    sort_field, sort_order)
-            resp_users = resp.get('results')
-            results.extend(resp_users)
-            count += int(resp['num'])
-            nextstart = int(resp['nextStart'])
-
-        return results
+        def page(start, num):
+            return self._users_page(q, start, num, sort_field, sort_order)
+        return self._iter_pages(page, 'results', max_users, parallel,
+                                fields)
 
 
 
@@ -1388,6 +1785,28 @@ class Portal(object):
             return resp.get('success')
 
 
+    def stats(self):
+        """ Returns statistics about the requests made so far, to find the
+        slow or busy parts of the API.
+
+        .. note::
+            The statistics are grouped by REST path, with the names and ids
+            in the path replaced by placeholders, like
+            'community/users/{user}' or 'content/users/{user}/{folder}'.
+
+        :return:
+            a dict of path to a dict with the number of requests (count),
+            failed requests (errors), retried attempts (retries) and logins
+            after the token expired (relogins); the total, mean and max
+            latency in seconds (latency_sum, latency_mean, latency_max) and
+            a latency_histogram list of (upper bound, count) pairs; and the
+            request and response body sizes (bytes_sent, bytes_received,
+            bytes_decoded), with the response compression ratio
+            (gzip_ratio).
+        """
+        return self.con.metrics.stats()
+
+
     def update_user(self, username, access=None, preferred_view=None,
                     description=None, tags=None, thumbnail=None,
                     fullname=None, email=None, culture=None,
@@ -1454,6 +1873,7 @@ class Portal(object):
                 thumbnail = urllib.urlretrieve(thumbnail)[0]
                 file_ext = os.path.splitext(thumbnail)[1]
                 if not file_ext:
+                    import imghdr
                     file_ext = imghdr.what(thumbnail)
                     if file_ext in ('gif', 'png', 'jpeg'):
                         new_thumbnail = thumbnail + '.' + file_ext
@@ -1570,6 +1990,7 @@ class Portal(object):
                 thumbnail = urllib.urlretrieve(thumbnail)[0]
                 file_ext = os.path.splitext(thumbnail)[1]
                 if not file_ext:
+                    import imghdr
                     file_ext = imghdr.what(thumbnail)
                     if file_ext in ('gif', 'png', 'jpeg'):
                         new_thumbnail = thumbnail + '.' + file_ext
@@ -1582,6 +2003,21 @@ class Portal(object):
             return resp.get('success')
 
 
+    def write_metrics(self, filepath):
+        """ Writes the statistics returned by stats() to a file in the
+        Prometheus text format, for example for node_exporter's textfile
+        collector.  Call it regularly (say once a minute) from a long job.
+
+        ================  ========================================================
+        **Argument**      **Description**
+        ----------------  --------------------------------------------------------
+        filepath          required string, the file to write (it's replaced
+                          in one step, so readers never see part of it)
+        ================  ========================================================
+        """
+        self.con.metrics.write_prometheus(filepath)
+
+
 
     def get_version(self, force=False):
         """ Returns the portal version (using cache unless force=True). 
@@ -1707,6 +2143,216 @@ class Portal(object):
                               + 'values are "public", "org", and "default"')
 
 
+    def _add_item_multipart(self, path, owner, postdata, files, part_size,
+                            parallel):
+        # The data is uploaded in parts; any other files (the thumbnail and
+        # metadata) are sent when the item is created
+        (_, filepath, filename) = [f for f in files if f[0] == 'file'][0]
+        files = [f for f in files if f[0] != 'file']
+        size = os.path.getsize(filepath)
+        part_size = max(part_size, _MIN_PART_SIZE, -(-size // _MAX_PARTS))
+        num_parts = max(1, -(-size // part_size))
+
+        # Uploads are tracked in a state file named after the destination and
+        # the file, so a crashed upload of the same file can be resumed
+        key = '|'.join([self.resturl, path, os.path.abspath(filepath),
+                        str(size), str(os.path.getmtime(filepath))])
+        statefile = os.path.join(self._get_workdir(), 'portalpy-upload-'
+                                 + hashlib.sha1(_utf8(key)).hexdigest() + '.json')
+        try:
+            with open(statefile) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = None
+        if state and state.get('partSize') == part_size and state.get('itemId'):
+            _log.info('Resuming upload of ' + filepath + ' (item '
+                      + state['itemId'] + ')')
+        else:
+            state = None
+
+        # Create the item; its data is added part by part below
+        if not state:
+            create_postdata = dict(postdata)
+            create_postdata.update({'multipart': 'true',
+                                    'filename': _utf8(filename)})
+            resp = self.con.post(path, create_postdata, files)
+            if not resp or not resp.get('success'):
+                return None
+            state = {'itemId': resp['id'], 'partSize': part_size, 'parts': []}
+        item_path = 'content/users/' + owner + '/items/' + state['itemId']
+        lock = threading.Lock()
+
+        def save_state():
+            _write_file(statefile, json.dumps(state))
+
+        def upload_part(part_num):
+            offset = (part_num - 1) * part_size
+            segment = _FileSegment(filepath, offset, min(part_size, size - offset))
+            for attempt in range(_PART_RETRIES + 1):
+                try:
+                    part_postdata = self._postdata()
+                    part_postdata['partNum'] = part_num
+                    resp = self.con.post(item_path + '/addPart', part_postdata,
+                                         [('file', segment, filename)])
+                    if resp and resp.get('success'):
+                        break
+                except (httplib.HTTPException, socket.error, urllib2.URLError) as e:
+                    if attempt == _PART_RETRIES:
+                        raise
+                    _log.warning('Part ' + str(part_num) + ' failed (' + str(e) + ')')
+                if attempt == _PART_RETRIES:
+                    raise RuntimeError('Failed to upload part ' + str(part_num)
+                                       + ' of ' + filepath)
+                time.sleep(2 ** attempt)
+            with lock:
+                state['parts'].append(part_num)
+                save_state()
+
+        save_state()
+        pending = [n for n in range(1, num_parts + 1) if n not in state['parts']]
+        _parallel_map(upload_part, pending, parallel)
+
+        # Commit the parts, then wait for the portal to assemble the item
+        resp = self.con.post(item_path + '/commit', postdata)
+        if not resp or not resp.get('success'):
+            return None
+        # Small items are often ready at once, so check straight away, then
+        # back off until the deadline
+        deadline = time.time() + _COMMIT_TIMEOUT
+        delay = 0.1
+        while True:
+            resp = self.con.post(item_path + '/status', self._postdata())
+            status = resp.get('status') if resp else 'failed'
+            remaining = deadline - time.time()
+            if status not in ('processing', 'partial') or remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, _COMMIT_POLL_MAX)
+        if status in ('processing', 'partial'):
+            _log.error('Timed out waiting for the portal to assemble '
+                       + filepath + ' (item ' + state['itemId'] + ')')
+            return None
+        if status != 'completed':
+            _log.error('Multipart upload of ' + filepath + ' failed: ' + str(resp))
+            return None
+        os.remove(statefile)
+        return state['itemId']
+
+
+    def _iter_pages(self, page, results_key, max_results, parallel=1,
+                    fields=None, limit=_SEARCH_RESULT_LIMIT):
+        # Pages are requested in the background while the records of the
+        # current page are handed out. When fetching in parallel, the first
+        # page tells us the total and the page size the server uses, so the
+        # start of every remaining page is known up front; pages are still
+        # yielded in order, which keeps the server's sort order. Searches
+        # can't page past limit results, whatever their total.
+        if fields:
+            # Project each page as soon as it arrives, so the full records
+            # are never held on to
+            fetch_page = page
+            def page(start, num):
+                resp = fetch_page(start, num)
+                resp[results_key] = self._extract(resp.get(results_key), fields)
+                return resp
+        resp = page(1, min(max_results, 100))
+        count = int(resp['num'])
+        nextstart = int(resp['nextStart'])
+        if parallel > 1 and 0 < count < max_results and nextstart > 0:
+            total = min(int(resp['total']), max_results)
+            if limit:
+                total = min(total, limit)
+            starts = collections.deque(range(nextstart, total + 1, count))
+            fetching = collections.deque()
+            while True:
+                while starts and len(fetching) < parallel:
+                    start = starts.popleft()
+                    fetching.append(_BackgroundCall(page, start,
+                                                    min(total - start + 1, count)))
+                for record in resp.get(results_key):
+                    yield record
+                if not fetching:
+                    return
+                resp = fetching.popleft().result()
+
+        while True:
+            nextpage = None
+            if count < max_results and nextstart > 0:
+                nextpage = _BackgroundCall(page, nextstart,
+                                           min(max_results - count, 100))
+            for record in resp.get(results_key):
+                yield record
+            if not nextpage:
+                return
+            resp = nextpage.result()
+            count += int(resp['num'])
+            nextstart = int(resp['nextStart'])
+
+
+    def _bootstrap(self, username):
+        # Store the logged in user information. It's useful. (This makes
+        # the login, if it was deferred; if it fails there's no user.)
+        if self.con._current_token():
+            self._logged_in_user = self.get_user(username)
+        else:
+            self._logged_in_user = None
+        self._cached_login = False
+
+        self.get_version(True)
+        self.get_properties(True)
+        if self._bootstrap_file and self._properties \
+                and (self._logged_in_user or not username):
+            self._save_bootstrap()
+
+
+    def _refresh_bootstrap(self, username):
+        # Runs in the background, so errors are logged rather than lost
+        try:
+            self._bootstrap(username)
+        except Exception as e:
+            _log.warning('Unable to refresh the bootstrap cache: ' + str(e))
+
+
+    def _get_workdir(self):
+        if not self.workdir:
+            import tempfile
+            self.workdir = tempfile.gettempdir()
+        return self.workdir
+
+
+    def _load_bootstrap(self, ttl):
+        try:
+            with open(self._bootstrap_file) as f:
+                cache = _decode_json(f.read())
+        except (IOError, ValueError):
+            return False
+        if time.time() - cache.get('timestamp', 0) > ttl:
+            return False
+        _log.debug('Using bootstrap cache: ' + self._bootstrap_file)
+        self.resturl = cache['resturl']
+        self._version = cache['version']
+        self._properties = cache['properties']
+        self._is_pre_162 = cache['is_pre_162']
+        self._is_pre_21 = cache['is_pre_21']
+        self._logged_in_user = cache['logged_in_user']
+        return True
+
+
+    def _save_bootstrap(self):
+        cache = { 'timestamp': time.time(), 'resturl': self.resturl,
+                  'version': self._version, 'properties': self._properties,
+                  'is_pre_162': self._is_pre_162, 'is_pre_21': self._is_pre_21,
+                  'logged_in_user': self._logged_in_user }
+        try:
+            # The cache holds user details, so only the owner can read it
+            fd = os.open(self._bootstrap_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+        except (IOError, OSError) as e:
+            _log.warning('Unable to save the bootstrap cache: ' + str(e))
+
+
     def _invitations_page(self, start, num):
         postdata = self._postdata()
         postdata.update({ 'start': start, 'num': num })
@@ -1716,8 +2362,9 @@ class Portal(object):
   
     def _postdata(self):
         if self._basepostdata:
-            # Return a defensive copy
-            return copy.deepcopy(self._basepostdata)
+            # The base postdata only holds strings, so a shallow copy is
+            # all each request needs
+            return dict(self._basepostdata)
         return None
 
 
@@ -1770,12 +2417,684 @@ class Portal(object):
             newresults.append(newresult)
         return newresults
 
+class ThreadedPortal(object):
+    """ Runs Portal methods concurrently, on a pool of threads.  Each method
+    takes the same arguments as the Portal method of the same name, but
+    returns at once with a future; call result() on the future to wait for
+    the return value (or the error).
+
+    .. note::
+        The calls run on a pool of up to max_workers threads, which share
+        the portal's pool of keep-alive connections and its token.  Each
+        call holds a thread while it runs, so at most max_workers calls are
+        in flight at once, and the others wait in a queue; raise
+        max_workers for more, at the cost of a thread each.  The portal is
+        constructed lazily, so the constructor doesn't block either.  Other
+        keyword arguments are passed to the Portal constructor, or pass an
+        existing Portal as portal.
+
+    Example - fetch many users at once
+
+    .. code-block:: python
+
+        aportal = portalpy.ThreadedPortal(portalUrl, user, password)
+        futures = [aportal.get_user(name) for name in usernames]
+        for user in aportal.gather(futures):
+            print user['fullName']
+        aportal.close()
+
+    """
+
+    def __init__(self, url=None, username=None, password=None,
+                 max_workers=50, portal=None, **kwargs):
+        if portal is None and not url:
+            raise ValueError('ThreadedPortal needs a url or a portal')
+        if portal is None:
+            kwargs.setdefault('pool_size', max_workers)
+            kwargs.setdefault('lazy', True)
+            portal = Portal(url, username, password, **kwargs)
+        self.portal = portal
+        self._workers = _WorkerPool(max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        """ Runs func(*args, **kwargs) on the pool and returns a future. """
+        return self._workers.submit(func, *args, **kwargs)
+
+    def gather(self, futures, timeout=None):
+        """ Waits for each of the futures and returns their results, in
+        order.  The first error raised is re-raised. """
+        return [future.result(timeout) for future in futures]
+
+    def close(self, wait=True):
+        """ Stops the worker threads once the calls already submitted are
+        done (waiting for them unless wait is False). """
+        self._workers.shutdown(wait)
+
+
+def _threaded_method(name):
+    def method(self, *args, **kwargs):
+        return self._workers.submit(getattr(self.portal, name), *args,
+                                    **kwargs)
+    method.__name__ = name
+    method.__doc__ = ' Runs Portal.' + name + ' on the pool and returns a ' \
+                     'future for its result. '
+    return method
+
+for _name in ('add_group_users', 'add_item', 'create_folder', 'create_group',
+              'create_group_from_dict', 'delete_folder', 'delete_group',
+              'delete_item', 'delete_items', 'delete_user', 'get_folder_id',
+              'get_group', 'get_group_members', 'get_group_thumbnail',
+              'get_org_users', 'get_properties', 'get_user', 'get_users',
+              'get_version', 'invite_group_users', 'leave_group',
+              'logged_in_user', 'reassign_group', 'reassign_item',
+              'reassign_user', 'remove_group_users', 'reset_user', 'search',
+              'search_groups', 'search_sharded', 'search_users',
+              'update_group', 'update_user', 'update_user_role'):
+    setattr(ThreadedPortal, _name, _threaded_method(_name))
+del _name
+
+class PortalStore(object):
+    """ A local SQLite copy of a portal's users, groups and items.
+
+    .. note::
+        The first sync copies everything.  Users are copied in full on every
+        sync (the portal doesn't document searching users by modification
+        date), so deleted users are dropped.  Later syncs only fetch the
+        groups and items modified since the newest one already in the store,
+        so they are quick, but they don't notice deleted groups and items
+        (or ones no longer shared with the portal's user), which stay in the
+        store.  Sync with full=True to start over.  Queries only read the
+        local database.
+
+    Example - list a user's web maps
+
+    .. code-block:: python
+
+        store = portalpy.PortalStore('myorg.db')
+        store.sync(portal)
+        for item in store.items(owner='amy.user', type='Web Map'):
+            print item['title']
+
+    """
+
+    _columns = {
+        'users': ('username', 'fullName', 'role', 'modified'),
+        'groups': ('id', 'title', 'owner', 'modified'),
+        'items': ('id', 'title', 'owner', 'type', 'modified'),
+    }
+    _indexes = [('users', 'modified'), ('users', 'role'),
+                ('groups', 'owner'), ('groups', 'modified'),
+                ('items', 'owner'), ('items', 'type'), ('items', 'modified')]
+
+    def __init__(self, path):
+        """ Opens (or creates) the store in the SQLite database at path. """
+        import sqlite3
+        self.path = path
+        self._db = sqlite3.connect(path)
+        for table, columns in self._columns.iteritems():
+            self._db.execute('CREATE TABLE IF NOT EXISTS ' + table + ' ('
+                             + columns[0] + ' TEXT PRIMARY KEY, '
+                             + ', '.join(columns[1:]) + ', json TEXT)')
+        for table, column in self._indexes:
+            self._db.execute('CREATE INDEX IF NOT EXISTS ' + table + '_'
+                             + column + ' ON ' + table + ' (' + column + ')')
+        self._db.commit()
+
+    def close(self):
+        """ Closes the database. """
+        self._db.close()
+
+    def sync(self, portal, full=False, parallel=4):
+        """ Copies all users, and new and modified groups and items, from the
+        portal.
+
+        ================  ========================================================
+        **Argument**      **Description**
+        ----------------  --------------------------------------------------------
+        portal            required Portal, the portal to copy from
+        ----------------  --------------------------------------------------------
+        full              optional boolean, empty the store and copy everything
+        ----------------  --------------------------------------------------------
+        parallel          optional int, number of requests made at once
+        ================  ========================================================
+
+        :return:
+            a dict with the number of users, groups and items copied.
+        """
+        if full:
+            for table in self._columns:
+                self._db.execute('DELETE FROM ' + table)
+
+        # The org users listing has every user, with their roles, so the
+        # users are replaced (in the same transaction, so queries never see
+        # the table empty)
+        counts = {}
+        users = list(portal.iter_org_users(sys.maxint, parallel))
+        self._db.execute('DELETE FROM users')
+        counts['users'] = self._save('users', users)
+
+        since = self._watermark('groups')
+        groups = portal.iter_search_groups(_modified_query(since or 0),
+                                           max_groups=sys.maxint,
+                                           parallel=parallel)
+        counts['groups'] = self._save('groups', groups)
+
+        since = self._watermark('items')
+        items = portal.search_sharded(_modified_query(since or 0),
+                                      parallel=parallel)
+        counts['items'] = self._save('items', items)
+
+        self._db.commit()
+        return counts
+
+    def users(self, **criteria):
+        """ Returns the users matching all of the criteria, for example
+        users(role='org_admin').  Criteria can be username, fullName, role,
+        modified or modified_since. """
+        return self._select('users', criteria)
+
+    def groups(self, **criteria):
+        """ Returns the groups matching all of the criteria, for example
+        groups(owner='amy.user').  Criteria can be id, title, owner, modified
+        or modified_since. """
+        return self._select('groups', criteria)
+
+    def items(self, **criteria):
+        """ Returns the items matching all of the criteria, for example
+        items(type='Web Map', modified_since=1388534400000).  Criteria can be
+        id, title, owner, type, modified or modified_since. """
+        return self._select('items', criteria)
+
+    def _watermark(self, table):
+        return self._db.execute('SELECT MAX(modified) FROM ' + table).fetchone()[0]
+
+    def _save(self, table, records):
+        columns = self._columns[table]
+        rows = (tuple(record.get(column) for column in columns)
+                + (json.dumps(record),) for record in records)
+        cursor = self._db.executemany('INSERT OR REPLACE INTO ' + table
+                                      + ' VALUES (' + ', '.join('?' * (len(columns) + 1))
+                                      + ')', rows)
+        return cursor.rowcount
+
+    def _select(self, table, criteria):
+        clauses = []
+        params = []
+        for column, value in criteria.iteritems():
+            if column == 'modified_since':
+                clauses.append('modified >= ?')
+            elif column in self._columns[table]:
+                clauses.append(column + ' = ?')
+            else:
+                raise ValueError('Unknown criteria "' + column + '" for '
+                                 + table)
+            params.append(value)
+        sql = 'SELECT json FROM ' + table
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        return [_decode_json(row[0])
+                for row in self._db.execute(sql + ' ORDER BY modified', params)]
+
+
+class RetryPolicy(object):
+    """ How requests that fail for a transient reason are retried.
+
+    .. note::
+        Reads (GETs, and POSTs to searches and other operations that don't
+        change anything) that get a response with one of the statuses, time
+        out, lose their connection or get a truncated body are retried up to
+        total times.  Between attempts the client waits a random time of up
+        to backoff_factor * 2^attempt seconds (but no more than max_backoff),
+        or as long as the portal's Retry-After header asks.  Writes are
+        never retried.
+
+        Once breaker_threshold requests to a host have failed in a row, the
+        client stops sending requests to it, failing them at once with a
+        RuntimeError, for breaker_timeout seconds.  It then lets one request
+        through to see whether the host has recovered.  Set
+        breaker_threshold to 0 to turn this off.
+
+    Example - retry harder during a long batch job
+
+    .. code-block:: python
+
+        policy = portalpy.RetryPolicy(total=8, max_backoff=120)
+        portal = portalpy.Portal(portalUrl, user, password,
+                                 retry_policy=policy)
+
+    """
+
+    def __init__(self, total=3, backoff_factor=0.5, max_backoff=30,
+                 statuses=(429, 502, 503, 504), respect_retry_after=True,
+                 breaker_threshold=5, breaker_timeout=30):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.respect_retry_after = respect_retry_after
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+
+    def backoff(self, attempt, retry_after=None):
+        """ Returns the number of seconds to wait before the next attempt
+        (attempt is 0 for the first retry). """
+        if retry_after is not None and self.respect_retry_after:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff_factor * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """ Limits how fast requests are sent to the portal, so that many
+    threads sharing a Portal don't overload it and get throttled.
+
+    .. note::
+        Requests are sorted into classes: 'search' (searches and user, group
+        and org user listings), 'upload' (adding items and parts), 'write'
+        (other requests that change the portal) and 'default' (the rest).
+        Each class has its own token bucket, allowing the given number of
+        requests per second on average, in bursts of up to burst requests
+        (by default, one second's worth).  Requests wait for their turn.
+
+        With adaptive=True the rates are the most allowed.  Each class starts
+        at its rate, which is cut by 30% whenever the portal's recent
+        response times climb above latency_tolerance times their long-run
+        average (or above target_latency seconds, if given) or it answers
+        429 or 503, and otherwise rises by about one request per second each
+        second.  This settles near the rate the portal can sustain, rather
+        than swinging between overloading it and idling.
+
+    Example - share a portal between 20 worker threads
+
+    .. code-block:: python
+
+        limiter = portalpy.RateLimiter({'search': 20, 'write': 5},
+                                       adaptive=True)
+        portal = portalpy.Portal(portalUrl, user, password,
+                                 rate_limiter=limiter)
+
+    """
+
+    default_rates = { 'search': 10, 'write': 5, 'upload': 2, 'default': 20 }
+
+    def __init__(self, rates=None, burst=None, adaptive=False,
+                 latency_tolerance=2.0, target_latency=None):
+        self.rates = dict(self.default_rates)
+        self.rates.update(rates or {})
+        self.adaptive = adaptive
+        self.latency_tolerance = latency_tolerance
+        self.target_latency = target_latency
+        self._buckets = dict((kind, _TokenBucket(rate, burst or max(1, rate)))
+                             for kind, rate in self.rates.iteritems())
+
+    def rate(self, kind):
+        """ Returns the current rate (requests per second) of a class. """
+        return self._buckets[kind].rate
+
+    def acquire(self, kind):
+        """ Waits until a request of the class may be sent. """
+        self._buckets[kind].acquire()
+
+    def record(self, kind, latency, overloaded=False):
+        """ Records how long the portal took to respond to a request of
+        the class, and whether it said it was overloaded. """
+        if self.adaptive:
+            self._buckets[kind].adapt(latency, overloaded,
+                                      self.latency_tolerance,
+                                      self.target_latency)
+
+
+class Tracer(object):
+    """ Records what a portal does as nested spans, and writes them to a
+    JSON trace file when closed.
+
+    .. note::
+        Each call of a Portal method is a span, containing spans for the
+        other methods it calls and the requests it makes, which in turn
+        contain spans for the phases of each request (connect, tls, send,
+        first_byte, receive and decode).  The file is in the Trace Event
+        format, so it can be opened in chrome://tracing or Perfetto, or read
+        as JSON: each span has a name, a start (ts) and duration (dur) in
+        microseconds, and args including its span_id and parent_id.
+
+    Example - see where the time goes when deleting a user
+
+    .. code-block:: python
+
+        with portalpy.Tracer(portal, 'delete_user.json'):
+            portal.delete_user('amy.user', reassign_to='bob.user')
+
+    """
+
+    # Portal methods that aren't worth a span
+    _untraced = ('add_hook', 'remove_hook', 'stats', 'write_metrics')
+
+    def __init__(self, portal, filepath):
+        self.portal = portal
+        self.filepath = filepath
+        self._spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        # Each thread's stack of open spans is kept in its _caller_state, so
+        # the threads that fetch pages, users and shards for a method carry
+        # on with the stack of the thread that called it
+        self._key = 'tracer_spans_%d' % id(self)
+
+        # Trace the portal's public methods (on this portal only) and its
+        # requests
+        self._methods = []
+        for name in dir(Portal):
+            if name.startswith('_') or name in self._untraced \
+                    or not callable(getattr(Portal, name)):
+                continue
+            setattr(portal, name, self._traced(name, getattr(portal, name)))
+            self._methods.append(name)
+        portal.add_hook('after_response', self._add_request)
+        portal.add_hook('on_error', self._add_request)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """ Records a span around a block of code, for example
+        with tracer.span('load users', count=len(users)): ... """
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        span_id = next(self._ids)
+        stack.append(span_id)
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            args['error'] = str(e)
+            raise
+        finally:
+            stack.pop()
+            self._add(name, start, time.time() - start, span_id, parent, args)
+
+    def close(self):
+        """ Stops tracing and writes the trace file. """
+        self.portal.remove_hook('after_response', self._add_request)
+        self.portal.remove_hook('on_error', self._add_request)
+        for name in self._methods:
+            delattr(self.portal, name)
+        self._methods = []
+        with self._lock:
+            spans = sorted(self._spans, key=lambda span: span['ts'])
+        with open(self.filepath, 'w') as f:
+            json.dump({ 'traceEvents': spans, 'displayTimeUnit': 'ms' }, f)
+
+    def _traced(self, name, method):
+        def traced(*args, **kwargs):
+            with self.span(name):
+                return method(*args, **kwargs)
+        traced.__name__ = name
+        traced.__doc__ = method.__doc__
+        return traced
+
+    def _stack(self):
+        return _caller_state.__dict__.setdefault(self._key, [])
+
+    def _add_request(self, info, error=None):
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        span_id = next(self._ids)
+        timings = info['timings']
+        args = dict((key, info[key]) for key in
+                    ('url', 'status', 'retries', 'bytes_sent',
+                     'bytes_received', 'bytes_decoded'))
+        if error is not None:
+            args['error'] = str(error)
+        end = info['start'] + timings['total']
+        self._add(info['method'] + ' ' + info['path'], info['start'],
+                  timings['total'], span_id, parent, args)
+
+        # The phases of the last attempt ran back to back, up to the end
+        for phase in reversed(_PHASES):
+            if timings.get(phase):
+                end -= timings[phase]
+                self._add(phase, end, timings[phase], next(self._ids),
+                          span_id, {})
+
+    def _add(self, name, start, duration, span_id, parent, args):
+        args = dict(args, span_id=span_id, parent_id=parent)
+        span = { 'name': name, 'ph': 'X', 'ts': int(start * 1000000),
+                 'dur': int(duration * 1000000), 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident, 'args': args }
+        with self._lock:
+            self._spans.append(span)
+
+
+class RecordingTransport(object):
+    """ Records the requests a portal makes and the responses it gets to a
+    file, so the session can be played back later by a ReplayTransport.
+
+    .. note::
+        Requests are still sent, through the portal's own connection pool
+        unless another transport is given.  Each request and its response
+        (or the error it failed with) is written as a line of JSON to the
+        file, which is gzip compressed.  Tokens and passwords are redacted
+        from the URLs, request bodies and responses, and uploaded files
+        aren't recorded, only their size.  Close the transport (or use it
+        as a context manager) when the session is over, to finish the file.
+
+    Example - record a session, then replay it
+
+    .. code-block:: python
+
+        with portalpy.RecordingTransport('session.json.gz') as recorder:
+            portal = portalpy.Portal(portalUrl, user, password,
+                                     transport=recorder)
+            portal.search('owner:amy.user')
+
+        replayer = portalpy.ReplayTransport('session.json.gz')
+        portal = portalpy.Portal(portalUrl, user, 'any password',
+                                 transport=replayer)
+        portal.search('owner:amy.user')
+
+    """
+
+    def __init__(self, filepath, transport=None):
+        self.filepath = filepath
+        self.transport = transport
+        import gzip
+        self._file = gzip.open(filepath, 'wb')
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def urlopen(self, method, url, body=None, headers=None, redirects=5,
+                timings=None):
+        """ Sends a request through the transport, and records it and its
+        response.  The response is read in full, and returned from memory. """
+        record = { 'method': method, 'url': _redact(url),
+                   'time': time.time() }
+        if body is None or isinstance(body, basestring):
+            record['body'] = _redact(body)
+        else:
+            record['body_size'] = len(body)
+        try:
+            try:
+                resp = self.transport.urlopen(method, url, body, headers,
+                                              redirects, timings)
+                try:
+                    status, reason, msg = resp.status, resp.reason, resp.msg
+                    data = resp.read()
+                finally:
+                    resp.close()
+            except urllib2.HTTPError as e:
+                status, reason, msg, data = e.code, e.msg, e.hdrs, e.read()
+        except (httplib.HTTPException, socket.error) as e:
+            record.update(elapsed=time.time() - record['time'],
+                          error=type(e).__name__, message=str(e))
+            self._write(record)
+            raise
+
+        header_lines = ''.join(line for line in msg.headers
+                               if not line.lower().startswith('set-cookie'))
+        record.update(elapsed=time.time() - record['time'], status=status,
+                      reason=reason, headers=header_lines)
+        self._write(record, _redact_body(data, msg))
+        record.update(headers=''.join(msg.headers))
+        return _replay_response(url, record, data)
+
+    def close(self):
+        """ Finishes the file. """
+        with self._lock:
+            self._file.close()
+
+    def _write(self, record, data=None):
+        if data is not None:
+            record = dict(record, data=base64.b64encode(data))
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+
+class ReplayTransport(object):
+    """ Plays back a session recorded by a RecordingTransport, in place of
+    sending requests, so a portal can be used without a network.
+
+    .. note::
+        A request gets the response recorded for the same method, path and
+        parameters (ignoring tokens, passwords and the referer), in the
+        order they were recorded.  A request made more often than it was
+        recorded gets its last recorded response again, and one that wasn't
+        recorded gets the next response recorded for the same path.  With
+        strict=True, both raise a RuntimeError instead, as does a request
+        to a path that wasn't recorded at all.  Recorded errors are raised
+        again, so retries are replayed too.
+
+        Responses are returned at once, or with speed set, after the time
+        the portal took divided by speed (so 1 replays at the recorded
+        pace).  Tokens from generateToken have the lifetime they had when
+        recorded, counted from when they are replayed.
+
+    Example - replay a session as fast as possible
+
+    .. code-block:: python
+
+        replayer = portalpy.ReplayTransport('session.json.gz')
+        portal = portalpy.Portal(portalUrl, user, 'any password',
+                                 transport=replayer)
+        portal.search('owner:amy.user')
+        print replayer.replayed, replayer.missed
+
+    """
+
+    def __init__(self, filepath, strict=False, speed=None):
+        self.filepath = filepath
+        self.strict = strict
+        self.speed = speed
+        self.replayed = 0
+        self.missed = 0
+        import gzip
+        with gzip.open(filepath, 'rb') as f:
+            self.interactions = [json.loads(line) for line in f]
+        self._exact = collections.defaultdict(collections.deque)
+        self._by_path = collections.defaultdict(collections.deque)
+        self._last = {}
+        self._used = set()
+        self._lock = threading.Lock()
+        for record in self.interactions:
+            key = _request_key(record['method'], record['url'],
+                               record.get('body'))
+            self._exact[key].append(record)
+            self._by_path[key[:2]].append(record)
+
+    def urlopen(self, method, url, body=None, headers=None, redirects=5,
+                timings=None):
+        """ Returns the recorded response to a request (or raises the
+        recorded error).  A file-like body is read, as if it were sent. """
+        if hasattr(body, 'read'):
+            while body.read(_CHUNK_SIZE):
+                pass
+        key = _request_key(method, url, body)
+        with self._lock:
+            record = self._match(key)
+            self.replayed += 1
+        if self.speed:
+            time.sleep(record['elapsed'] / self.speed)
+        if timings is not None:
+            for phase in ('connect', 'tls', 'send', 'first_byte'):
+                timings[phase] = 0.0
+        if 'error' in record:
+            if record['error'] == 'timeout':
+                raise socket.timeout(record['message'])
+            raise socket.error(record['message'])
+        data = base64.b64decode(record['data'])
+        if key[1].endswith('/generateToken'):
+            data = self._renew_expiry(record, data)
+        return _replay_response(url, record, data)
+
+    def _match(self, key):
+        exact = self._exact.get(key)
+        record = self._next(exact)
+        if record is None:
+            if self.strict:
+                raise RuntimeError('No recorded response (left) for '
+                                   + key[0] + ' ' + key[1])
+            self.missed += 1
+            record = self._last.get(key) if exact is not None else None
+            record = record or self._next(self._by_path.get(key[:2])) \
+                or self._last.get(key[:2])
+            if record is None:
+                raise RuntimeError('No recorded response for '
+                                   + key[0] + ' ' + key[1])
+        self._last[key] = self._last[key[:2]] = record
+        return record
+
+    def _next(self, queue):
+        while queue:
+            record = queue.popleft()
+            if id(record) not in self._used:
+                self._used.add(id(record))
+                return record
+
+    def _renew_expiry(self, record, data):
+        gzipped = 'content-encoding: gzip' in record['headers'].lower()
+        if gzipped:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        try:
+            resp = json.loads(data)
+        except ValueError:
+            return data
+        if isinstance(resp, dict) and resp.get('expires'):
+            lifetime = resp['expires'] - record['time'] * 1000
+            resp['expires'] = int(time.time() * 1000 + lifetime)
+            data = json.dumps(resp)
+        return _gzip(data) if gzipped else data
+
+
 class _ArcGISConnection(object):
-    """ A class users to manage connection to ArcGIS services (Portal and Server). """
+    """ A class users to manage connection to ArcGIS services (Portal and Server).
+
+    get, post and download are safe to call from many threads at once. They
+    never change the caller's postdata, and token renewals are made under a
+    lock, so only one thread logs in again while the others wait for (and
+    then use) its new token. """
 
     def __init__(self, baseurl, username=None, password=None, key_file=None,
                  cert_file=None, expiration=60, all_ssl=False, referer=None,
-                 proxy_host=None, proxy_port=None, ensure_ascii=True):
+                 proxy_host=None, proxy_port=None, ensure_ascii=True,
+                 pool_size=10, pool_idle_timeout=60, lazy=False,
+                 retry_policy=None, rate_limiter=None, coalesce=False,
+                 transport=None, timeout=None):
         """ The _ArcGISConnection constructor. Requires URL and optionally username/password. """
 
         self.baseurl = _normalize_url(baseurl)
@@ -1786,38 +3105,96 @@ class _ArcGISConnection(object):
         self.proxy_port = proxy_port
         self.ensure_ascii = ensure_ascii
         self.token = None
-
-        # Setup the referer and user agent
-        if not referer:
-            import socket
-            ip = socket.gethostbyname(socket.gethostname())
-            referer = socket.gethostbyaddr(ip)[0]
-        self._referer = referer
+        self._token_expires = None
+        self._renewing = False
+        self._renew_failures = 0
+        self._pending_login = None
+        self._logging_in = False
+        self._token_lock = threading.RLock()
+
+        # All requests share a pool of keep-alive connections, so repeated
+        # calls to the same host don't pay for a new TCP/SSL handshake.  They
+        # are sent by the transport, which is the pool unless another one
+        # was given (a RecordingTransport sends through the pool too).
+        self._pool = _ConnectionPool(pool_size, pool_idle_timeout, key_file,
+                                     cert_file, proxy_host, proxy_port,
+                                     timeout)
+        self.transport = transport or self._pool
+        if getattr(transport, 'transport', False) is None:
+            transport.transport = self._pool
+
+        # Transient failures are retried, and each host gets a circuit
+        # breaker so an overloaded portal isn't hammered with retries
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+        self.rate_limiter = rate_limiter
+
+        # Counts, latencies and sizes of the requests, by REST path
+        self.metrics = _Metrics()
+
+        # Functions called before and after each request (see add_hook)
+        self._hooks = {}
+        self._hooks_lock = threading.Lock()
+
+        # Identical reads in flight at once can share one request
+        self.coalesce = coalesce
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # Setup the referer (looked up when first used, as reverse DNS
+        # lookups can be slow) and user agent
+        self._referer_name = referer
         self._useragent = 'PortalPy/' + __version__
 
-        # Login if credentials were provided
-        if username and password:
+        # Login if credentials were provided (or on the first request that
+        # needs a token, if lazy)
+        if username and password and lazy:
+            self._pending_login = (username, password, expiration)
+            self._username = username
+        elif username and password:
             self.login(username, password, expiration)
         elif username or password:
             _log.warning('Both username and password required for login')
 
     def generate_token(self, username, password, expiration=60):
         """ Generates and returns a new token, but doesn't re-login. """
+        resp = self._generate_token(username, password, expiration)
+        if resp:
+            return resp.get('token')
+
+    def _generate_token(self, username, password, expiration):
         postdata = { 'username': username, 'password': password,
                      'client': 'referer', 'referer': self._referer,
                      'expiration': expiration, 'f': 'json' }
-        resp = self.post('generateToken', postdata, ssl=True)
-        if resp:
-            return resp.get('token')
+        return self.post('generateToken', postdata, ssl=True)
 
     def login(self, username, password, expiration=60):
         """ Logs into the portal using username/password. """
-        newtoken = self.generate_token(username, password, expiration)
+        issued = time.time()
+        resp = self._generate_token(username, password, expiration)
+        newtoken = resp.get('token') if resp else None
         if newtoken:
             self.token = newtoken
             self._username = username
             self._password = password
             self._expiration = expiration
+
+            # Work out when to renew the token. The portal may shorten the
+            # expiration it was asked for, and tells us when it expires (by
+            # its own clock, so an expiry in the past means the clocks differ
+            # and what was asked for is all we can go on).
+            lifetime = expiration * 60
+            if resp.get('expires'):
+                remaining = resp['expires'] / 1000.0 - issued
+                if remaining > 0:
+                    lifetime = min(lifetime, remaining)
+                else:
+                    _log.warning('Token expires before it was issued, the '
+                                 'portal\'s clock may be wrong')
+            lifetime = max(lifetime, _TOKEN_MIN_LIFETIME)
+            self._token_expires = issued + lifetime \
+                - min(_TOKEN_RENEW_MARGIN, lifetime / 10.0)
         return newtoken
 
     def relogin(self, expiration=None):
@@ -1829,13 +3206,77 @@ class _ArcGISConnection(object):
     def logout(self):
         """ Logs out of the portal. """
         self.token = None
+        self._pending_login = None
+
+    def _get_referer(self):
+        if not self._referer_name:
+            ip = socket.gethostbyname(socket.gethostname())
+            self._referer_name = socket.gethostbyaddr(ip)[0]
+        return self._referer_name
+
+    _referer = property(_get_referer)
 
     def is_logged_in(self):
         """ Returns true if logged into the portal. """
-        return self.token is not None
+        return self.token is not None or self._pending_login is not None
+
+    def _current_token(self):
+        """ Returns the token, logging in first if the login was deferred,
+        or renewing the token if it's about to expire. """
+        if self._pending_login or self._logging_in \
+                or (self.token and time.time() >= self._token_expires):
+            # Other threads wait here while one logs in or renews the token
+            with self._token_lock:
+                if self._pending_login:
+                    credentials, self._pending_login = self._pending_login, None
+                    self._logging_in = True
+                    try:
+                        self.login(*credentials)
+                    finally:
+                        self._logging_in = False
+                elif self.token and not self._renewing \
+                        and time.time() >= self._token_expires:
+                    _log.info('Token is about to expire, fetching a new token')
+                    self._renew_token()
+        return self.token
+
+    def _refresh_token(self, rejected_token):
+        """ Returns a new token after rejected_token was rejected. Only the
+        first thread to get here logs in again, the others get its token. """
+        with self._token_lock:
+            if self.token == rejected_token:
+                self._renew_token()
+            return self.token
+
+    def _renew_token(self):
+        # The login's own request must not try to renew the token again
+        self._renewing = True
+        renewed = None
+        try:
+            renewed = self.relogin()
+        finally:
+            self._renewing = False
+            if renewed:
+                self._renew_failures = 0
+            else:
+                # Keep the old token for now, rather than trying to log in
+                # again on every request
+                self._renew_failures += 1
+                delay = min(2 ** self._renew_failures, _TOKEN_RETRY_MAX)
+                _log.warning('Unable to renew the token, trying again in '
+                             '%d seconds', delay)
+                self._token_expires = time.time() + delay
 
     def get(self, path, ssl=False, compress=True, try_json=True, is_retry=False):
         """ Returns result of an HTTP GET. Handles token timeout and all SSL mode."""
+        if self.coalesce and not is_retry:
+            key = ('GET', path, ssl, compress, try_json)
+            return self._coalesced(key, self._get, path, ssl, compress,
+                                   try_json)
+        return self._get(path, ssl, compress, try_json, is_retry)
+
+    def _get(self, path, ssl=False, compress=True, try_json=True,
+             is_retry=False):
         url = path
         if not path.startswith('http://') and not path.startswith('https://'):
             url = self.baseurl + path
@@ -1843,64 +3284,46 @@ class _ArcGISConnection(object):
             url = url.replace('http://', 'https://')
 
         # Add the token if logged in
-        if self.is_logged_in():
-            url = self._url_add_token(url, self.token)
+        token = self._current_token()
+        if token:
+            url = self._url_add_token(url, token)
 
-        _log.debug('REQUEST (get): ' + url)
+        _log.debug('REQUEST (get): %s', url)
 
         try:
-            # Send the request and read the response
-            headers = [('Referer', self._referer),
-                       ('User-Agent', self._useragent)]
+            # Send the request and read the response, parsing it as JSON
+            # unless we're not trying to (if it isn't JSON, or we're not
+            # trying, the response is returned as is)
+            headers = {'Referer': self._referer,
+                       'User-Agent': self._useragent}
             if compress:
-                headers.append(('Accept-encoding', 'gzip'))
-            opener = urllib2.build_opener()
-            opener.addheaders = headers
-            resp = opener.open(url)
-            if resp.info().get('Content-Encoding') == 'gzip':
-                buf = StringIO(resp.read())
-                f = gzip.GzipFile(fileobj=buf)
-                resp_data = f.read()
-            else:
-                resp_data = resp.read()
-
-            # If we're not trying to parse to JSON, return response as is
-            if not try_json:
-                return resp_data
+                headers['Accept-Encoding'] = 'gzip'
+            parse = self._parse_json_or_text if try_json else None
+            resp_json = self._send('GET', url, headers=headers, parse=parse)
 
+            # Check for errors, and handle the case where the token timed
+            # out during use (and simply needs to be re-generated)
             try:
-                resp_json = json.loads(resp_data)
-
-                # Convert to ascii if directed to do so
-                if self.ensure_ascii:
-                    resp_json = _unicode_to_ascii(resp_json)
+                if resp_json.get('error', None):
+                    errorcode = resp_json['error']['code']
+                    if errorcode == 498 and not is_retry:
+                        _log.info('Token expired during get request, ' \
+                                  + 'fetching a new token and retrying')
+                        self.metrics.record_relogin(url)
+                        newtoken = self._refresh_token(token)
+                        newpath = self._url_add_token(path, newtoken)
+                        return self._get(newpath, ssl, compress, try_json, is_retry=True)
+                    elif errorcode == 498:
+                        raise RuntimeError('Invalid token')
+                    self._handle_json_error(resp_json['error'])
+                    return None
+            except AttributeError:
+                # Top-level JSON object isnt a dict (or the response isnt
+                # JSON), so can't have an error
+                pass
 
-                # Check for errors, and handle the case where the token timed
-                # out during use (and simply needs to be re-generated)
-                try:
-                    if resp_json.get('error', None):
-                        errorcode = resp_json['error']['code']
-                        if errorcode == 498 and not is_retry:
-                            _log.info('Token expired during get request, ' \
-                                      + 'fetching a new token and retrying')
-                            newtoken = self.relogin()
-                            newpath = self._url_add_token(path, newtoken)
-                            return self.get(newpath, ssl, compress, try_json, is_retry=True)
-                        elif errorcode == 498:
-                            raise RuntimeError('Invalid token')
-                        self._handle_json_error(resp_json['error'])
-                        return None
-                except AttributeError:
-                    # Top-level JSON object isnt a dict, so can't have an error
-                    pass
-
-                # If the JSON parsed correctly and there are no errors,
-                # return the JSON
-                return resp_json
-
-            # If we couldnt parse the response to JSON, return it as is
-            except ValueError:
-                return resp
+            # If there are no errors, return the JSON
+            return resp_json
 
         # If we got an HTTPError when making the request check to see if it's
         # related to token timeout, in which case, regenerate a token
@@ -1908,10 +3331,10 @@ class _ArcGISConnection(object):
             if e.code == 498 and not is_retry:
                 _log.info('Token expired during get request, fetching a new ' \
                           + 'token and retrying')
-                self.logout()
-                newtoken = self.relogin()
+                self.metrics.record_relogin(url)
+                newtoken = self._refresh_token(token)
                 newpath = self._url_add_token(path, newtoken)
-                return self.get(newpath, ssl, try_json, is_retry=True)
+                return self._get(newpath, ssl, compress, try_json, is_retry=True)
             elif e.code == 498:
                 raise RuntimeError('Invalid token')
             else:
@@ -1926,24 +3349,28 @@ class _ArcGISConnection(object):
             url = url.replace('http://', 'https://')
 
         # Add the token if logged in
-        if self.is_logged_in():
-            url = self._url_add_token(url, self.token)
+        token = self._current_token()
+        if token:
+            url = self._url_add_token(url, token)
 
-        _log.debug('REQUEST (download): ' + url + ', to ' + filepath)
+        _log.debug('REQUEST (download): %s, to %s', url, filepath)
 
         # Send the request, and handle the case where the token has
         # timed out (relogin and try again)
         try:
-            opener = _StrictURLopener()
-            opener.addheaders = [('Referer', self._referer),
-                                 ('User-Agent', self._useragent)]
-            opener.retrieve(url, filepath)
+            headers = {'Referer': self._referer,
+                       'User-Agent': self._useragent}
+            def save(resp):
+                with open(filepath, 'wb') as f:
+                    for chunk in _iter_response(resp):
+                        f.write(chunk)
+            self._send('GET', url, headers=headers, handler=save)
         except urllib2.HTTPError as e:
             if e.code == 498 and not is_retry:
                 _log.info('Token expired during download request, fetching a ' \
                           + 'new token and retrying')
-                self.logout()
-                newtoken = self.relogin()
+                self.metrics.record_relogin(url)
+                newtoken = self._refresh_token(token)
                 newpath = self._url_add_token(path, newtoken)
                 self.download(newpath, filepath, ssl, is_retry=True)
             elif e.code == 498:
@@ -1952,84 +3379,76 @@ class _ArcGISConnection(object):
                 raise e
 
     def _url_add_token(self, url, token):
-
-        # Parse the URL and query string
-        urlparts = urlparse.urlparse(url)
-        qs_list = urlparse.parse_qsl(urlparts.query)
-
-        # Update the token query string parameter
-        replaced_token = False
-        new_qs_list = []
-        for qs_param in qs_list:
-            if qs_param[0] == 'token':
-                qs_param = ('token', token)
-                replaced_token = True
-            new_qs_list.append(qs_param)
-        if not replaced_token:
-            new_qs_list.append(('token', token))
-
-        # Rebuild the URL from parts and return it
-        return urlparse.urlunparse((urlparts.scheme, urlparts.netloc,
-                                    urlparts.path, urlparts.params,
-                                    urllib.urlencode(new_qs_list),
-                                    urlparts.fragment))
+        """ Returns the URL with its token parameter set to token (or added).
+        The URL is rebuilt with a placeholder token the first time, and the
+        result is kept as a template to put other tokens in. """
+        if not isinstance(url, str):
+            return _url_with_token(url, token)
+        template = _token_url_templates.get(url)
+        if template is None:
+            template = _url_with_token(url, _TOKEN_PLACEHOLDER) \
+                .split(_TOKEN_PLACEHOLDER)
+            if len(template) != 2:
+                return _url_with_token(url, token)
+            if len(_token_url_templates) >= _URL_CACHE_SIZE:
+                _token_url_templates.clear()
+            _token_url_templates[url] = template
+        return template[0] + urllib.quote_plus(str(token)) + template[1]
 
     def post(self, path, postdata=None, files=None, ssl=False, compress=True,
              is_retry=False):
         """ Returns result of an HTTP POST. Supports Multipart requests."""
+        if self.coalesce and not files and not is_retry \
+                and _is_idempotent('POST', path):
+            params = sorted((k, v) for k, v in (postdata or {}).iteritems()
+                            if k != 'token')
+            key = ('POST', path, repr(params), ssl, compress)
+            return self._coalesced(key, self._post, path, postdata, files,
+                                   ssl, compress)
+        return self._post(path, postdata, files, ssl, compress, is_retry)
+
+    def _post(self, path, postdata=None, files=None, ssl=False, compress=True,
+              is_retry=False):
         url = path
         if not path.startswith('http://') and not path.startswith('https://'):
             url = self.baseurl + path
         if ssl or self.all_ssl:
             url = url.replace('http://', 'https://')
 
-        # Add the token if logged in
-        if self.is_logged_in():
-            postdata['token'] = self.token
+        # Add the token if logged in (to a copy of the postdata, as the
+        # caller's may be shared)
+        postdata = dict(postdata or {})
+        token = self._current_token()
+        if token:
+            postdata['token'] = token
 
         if _log.isEnabledFor(logging.DEBUG):
-            msg = 'REQUEST: ' + url + ', ' + str(postdata)
-            if files:
-                msg += ', files=' + str(files)
-            _log.debug(msg)
+            _log.debug('REQUEST: %s, %s%s', url, postdata,
+                       ', files=' + str(files) if files else '')
 
-        # If there are files present, send a multipart request
+        # If there are files present, send a multipart request, and parse
+        # the response into JSON either way
         if files:
             parsed_url = urlparse.urlparse(url)
-            resp_data = self._postmultipart(parsed_url.netloc,
+            resp_json = self._postmultipart(parsed_url.netloc,
                                             str(parsed_url.path),
                                             postdata,
                                             files,
-                                            parsed_url.scheme == 'https')
+                                            parsed_url.scheme == 'https',
+                                            self._parse_json)
 
         # Otherwise send a normal HTTP POST request
         else:
-            encoded_postdata = None
+            encoded_postdata = ''
             if postdata:
                 encoded_postdata = urllib.urlencode(postdata)
-            headers = [('Referer', self._referer),
-                       ('User-Agent', self._useragent)]
+            headers = {'Referer': self._referer,
+                       'User-Agent': self._useragent,
+                       'Content-Type': 'application/x-www-form-urlencoded'}
             if compress:
-                headers.append(('Accept-encoding', 'gzip'))
-            opener = urllib2.build_opener()
-            opener.addheaders = headers
-            resp = opener.open(url, data=encoded_postdata)
-            if resp.info().get('Content-Encoding') == 'gzip':
-                buf = StringIO(resp.read())
-                f = gzip.GzipFile(fileobj=buf)
-                resp_data = f.read()
-            else:
-                resp_data = resp.read()
-
-        # Parse the response into JSON
-        if _log.isEnabledFor(logging.DEBUG):
-            _log.debug('RESPONSE: ' + url + ', ' + _unicode_to_ascii(resp_data))
-        
-        resp_json = json.loads(resp_data)
-
-        # Convert to ascii if directed to do so
-        if self.ensure_ascii:
-            resp_json = _unicode_to_ascii(resp_json)
+                headers['Accept-Encoding'] = 'gzip'
+            resp_json = self._send('POST', url, encoded_postdata, headers,
+                                   parse=self._parse_json)
 
         # Check for errors, and handle the case where the token timed out
         # during use (and simply needs to be re-generated)
@@ -2039,11 +3458,10 @@ class _ArcGISConnection(object):
                 if errorcode == 498 and not is_retry:
                     _log.info('Token expired during post request, fetching a new '
                               + 'token and retrying')
-                    self.logout()
-                    newtoken = self.relogin()
-                    postdata['token'] = newtoken
-                    return self.post(path, postdata, files, ssl, compress,
-                                     is_retry=True)
+                    self.metrics.record_relogin(url)
+                    postdata['token'] = self._refresh_token(token)
+                    return self._post(path, postdata, files, ssl, compress,
+                                      is_retry=True)
                 elif errorcode == 498:
                     raise RuntimeError('Invalid token')
                 self._handle_json_error(resp_json['error'])
@@ -2054,53 +3472,248 @@ class _ArcGISConnection(object):
         
         return resp_json
 
-    def _postmultipart(self, host, selector, fields, files, ssl):
+    def _parse_json(self, resp_data):
+        # Log (the start of) the response, if debugging
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('RESPONSE: %d bytes: %s', len(resp_data),
+                       _remove_non_ascii(resp_data[:_LOG_BODY_LIMIT]))
+
+        # Parse the response into JSON (converting to ascii as it's parsed,
+        # if directed to do so)
+        return _decode_json(resp_data, self.ensure_ascii)
+
+    def _parse_json_or_text(self, resp_data):
+        try:
+            return _decode_json(resp_data, self.ensure_ascii)
+        except ValueError:
+            return resp_data
+
+    def _coalesced(self, key, func, *args):
+        """ Returns func(*args), or if an identical call (with the same key)
+        is already in flight, waits for it and returns a copy of its result.
+        Every caller gets a result of its own to change. """
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = [_Future(), 0]
+            else:
+                call[1] += 1
+        if not leader:
+            _log.debug('Waiting for identical request in flight: ' + key[1])
+            return copy.deepcopy(call[0].result())
+
+        try:
+            value = func(*args)
+        except Exception:
+            error = sys.exc_info()
+            with self._inflight_lock:
+                del self._inflight[key]
+            call[0]._set(error=error)
+            raise error[0], error[1], error[2]
+        with self._inflight_lock:
+            del self._inflight[key]
+            shared = call[1] > 0
+        call[0]._set(value)
+        return copy.deepcopy(value) if shared else value
+
+    def _postmultipart(self, host, selector, fields, files, ssl, parse=None):
         boundary, body = self._encode_multipart_formdata(fields, files)
         headers = {
         'User-Agent': self._useragent,
         'Referer': self._referer,
-        'Content-Type': 'multipart/form-data; boundary=%s' % boundary
+        'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+        'Content-Length': str(len(body))
         }
-        if self.proxy_host:
-            if ssl:
-                h = httplib.HTTPSConnection(self.proxy_host, self.proxy_port,
-                                            key_file=self.key_file,
-                                            cert_file=self.cert_file)
-                h.request('POST', 'https://' + host + selector, body, headers)
-            else:
-                h = httplib.HTTPConnection(self.proxy_host, self.proxy_port)
-                h.request('POST', 'http://' + host + selector, body, headers)
-        else:
-            if ssl:
-                h = httplib.HTTPSConnection(host, key_file=self.key_file,
-                                            cert_file=self.cert_file)
-                h.request('POST', selector, body, headers)
+        url = ('https://' if ssl else 'http://') + host + selector
+        try:
+            return self._send('POST', url, body, headers, parse=parse)
+        finally:
+            body.close()
+
+    def add_hook(self, event, hook):
+        """ Calls hook(info) before each request ('before_request'), after
+        each response ('after_response'), or hook(info, error) when one fails
+        ('on_error'). """
+        if event not in _HOOK_EVENTS:
+            raise ValueError('Unknown hook event: ' + str(event))
+        with self._hooks_lock:
+            hooks = dict((e, list(h)) for e, h in self._hooks.iteritems())
+            hooks.setdefault(event, []).append(hook)
+            self._hooks = hooks
+
+    def remove_hook(self, event, hook):
+        """ Stops calling a hook added with add_hook. """
+        with self._hooks_lock:
+            hooks = dict((e, list(h)) for e, h in self._hooks.iteritems())
+            if hook in hooks.get(event, []):
+                hooks[event].remove(hook)
+                if not hooks[event]:
+                    del hooks[event]
+            self._hooks = hooks
+
+    def _call_hooks(self, event, *args):
+        for hook in self._hooks.get(event, ()):
+            try:
+                hook(*args)
+            except Exception:
+                _log.exception('Error in ' + event + ' hook')
+
+    def _send(self, method, url, body=None, headers=None, handler=None,
+              parse=None):
+        """ Sends a request and returns handler(response), the body by
+        default, passed through parse if given.  Calls the hooks, if any. """
+        if not self._hooks:
+            result = self._send_attempts(method, url, body, headers, handler)
+            return parse(result) if parse else result
+
+        info = { 'method': method, 'url': url.split('?')[0],
+                 'path': _path_template(url), 'status': None, 'retries': 0,
+                 'bytes_sent': len(body) if body else 0, 'bytes_received': 0,
+                 'bytes_decoded': 0, 'start': time.time(), 'timings': {} }
+        self._call_hooks('before_request', info)
+        try:
+            result = self._send_attempts(method, url, body, headers, handler,
+                                         info)
+            if parse:
+                started = time.time()
+                result = parse(result)
+                info['timings']['decode'] = time.time() - started
+        except Exception as e:
+            error = sys.exc_info()
+            info['timings']['total'] = time.time() - info['start']
+            self._call_hooks('on_error', info, e)
+            raise error[0], error[1], error[2]
+        info['timings']['total'] = time.time() - info['start']
+        self._call_hooks('after_response', info)
+        return result
+
+    def _send_attempts(self, method, url, body=None, headers=None,
+                       handler=None, info=None):
+        """ Sends a request and returns handler(response).  Transient
+        failures of reads are retried as the retry policy says, and fail fast
+        while the host's breaker is open.  If info is given, the phase
+        timings and sizes of the (last) attempt are recorded in it. """
+        handler = handler or _read_response
+        timings = info['timings'] if info else None
+        limiter = self.rate_limiter
+        kind = _endpoint_class(method, url, body) if limiter else None
+        policy = self.retry_policy
+        retries = policy.total if _is_idempotent(method, url) else 0
+        breaker = self._get_breaker(url)
+        if breaker and not breaker.allow():
+            raise RuntimeError('Too many failed requests to '
+                               + _parse_hostname(url)
+                               + ', not sending more for now')
+        begun = time.time()
+        sent = len(body) if body else 0
+        attempt = 0
+        while True:
+            retry_after = None
+            if limiter:
+                limiter.acquire(kind)
+            started = time.time()
+            try:
+                resp = self.transport.urlopen(method, url, body, headers,
+                                              timings=timings)
+                if limiter:
+                    limiter.record(kind, time.time() - started)
+                if timings is None:
+                    result = handler(resp)
+                else:
+                    received = time.time()
+                    result = handler(resp)
+                    timings['receive'] = time.time() - received
+            except urllib2.HTTPError as e:
+                if info:
+                    info['status'] = e.code
+                    info['retries'] = attempt
+                if limiter:
+                    limiter.record(kind, time.time() - started,
+                                   e.code in (429, 503))
+                if e.code not in policy.statuses:
+                    if breaker:
+                        breaker.success()
+                    self.metrics.record(url, time.time() - begun,
+                                        sent * (attempt + 1), retries=attempt,
+                                        error=True)
+                    raise
+                error = sys.exc_info()
+                retry_after = _retry_after(e)
+            except (httplib.HTTPException, socket.error):
+                # Includes timeouts, resets and truncated (IncompleteRead)
+                # responses
+                error = sys.exc_info()
+                if limiter and isinstance(error[1], socket.timeout):
+                    limiter.record(kind, time.time() - started, True)
             else:
-                h = httplib.HTTPConnection(host)
-                h.request('POST', selector, body, headers)
-        return h.getresponse().read()
+                if breaker:
+                    breaker.success()
+                self.metrics.record(url, time.time() - begun,
+                                    sent * (attempt + 1), resp.bytes_received,
+                                    resp.bytes_decoded, attempt)
+                if info:
+                    info.update(status=resp.status, retries=attempt,
+                                bytes_received=resp.bytes_received,
+                                bytes_decoded=resp.bytes_decoded)
+                return result
+
+            if attempt >= retries:
+                if info:
+                    info['retries'] = attempt
+                if breaker:
+                    breaker.failure()
+                self.metrics.record(url, time.time() - begun,
+                                    sent * (attempt + 1), retries=attempt,
+                                    error=True)
+                raise error[0], error[1], error[2]
+            delay = policy.backoff(attempt, retry_after)
+            _log.warning('Request to ' + url.split('?')[0] + ' failed ('
+                         + (str(error[1]) or error[0].__name__)
+                         + '), retrying in %.1f seconds' % delay)
+            time.sleep(delay)
+            attempt += 1
+            if hasattr(body, 'seek'):
+                body.seek(0)
+
+    def _get_breaker(self, url):
+        policy = self.retry_policy
+        if not policy.breaker_threshold:
+            return None
+        host = urlparse.urlsplit(url).netloc
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = _CircuitBreaker(policy.breaker_threshold,
+                                          policy.breaker_timeout)
+                self._breakers[host] = breaker
+            return breaker
 
     def _encode_multipart_formdata(self, fields, files):
+        import mimetools
         boundary = mimetools.choose_boundary()
-        buf = StringIO()
+        parts = []
         for (key, value) in fields.iteritems():
-            buf.write('--%s\r\n' % boundary)
-            buf.write('Content-Disposition: form-data; name="%s"' % key)
-            buf.write('\r\n\r\n' + _tostr(value) + '\r\n')
+            parts.append(_utf8('--%s\r\n' % boundary
+                               + 'Content-Disposition: form-data; name="%s"' % key
+                               + '\r\n\r\n'
+                               + (value if isinstance(value, unicode) else _tostr(value))
+                               + '\r\n'))
         for (key, filepath, filename) in files:
-            buf.write('--%s\r\n' % boundary)
-            buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
-            buf.write('Content-Type: %s\r\n' % (self._get_content_type(filename)))
-            f = open(filepath, "rb")
-            try:
-                buf.write('\r\n' + f.read() + '\r\n')
-            finally:
-                f.close()
-        buf.write('--' + boundary + '--\r\n\r\n')
-        buf = buf.getvalue()
-        return boundary, buf
+            segment = filepath
+            if not isinstance(segment, _FileSegment):
+                segment = _FileSegment(filepath)
+            parts.append(_utf8('--%s\r\n' % boundary
+                               + 'Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename)
+                               + 'Content-Type: %s\r\n' % (self._get_content_type(filename))
+                               + '\r\n'))
+            parts.append(segment)
+            parts.append('\r\n')
+        parts.append('--' + boundary + '--\r\n\r\n')
+        return boundary, _MultipartBody(parts)
 
     def _get_content_type(self, filename):
+        import mimetypes
         return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
 
     def _handle_json_error(self, error):
@@ -2109,12 +3722,874 @@ class _ArcGISConnection(object):
             _log.error(errordetail)
 
 
-class _StrictURLopener(urllib.FancyURLopener):
-    def http_error_default(self, url, fp, errcode, errmsg, headers):
-        if errcode != 200:
-            raise urllib2.HTTPError(url, errcode, errmsg, headers, fp)
+class _ConnectionPool(object):
+    """ A per-host pool of reusable HTTP/1.1 keep-alive connections. """
+
+    def __init__(self, maxsize=10, idle_timeout=60, key_file=None,
+                 cert_file=None, proxy_host=None, proxy_port=None,
+                 timeout=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.proxy_host = proxy_host
+        self.proxy_port = proxy_port
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def urlopen(self, method, url, body=None, headers=None, redirects=5,
+                timings=None):
+        """ Sends a request on a pooled connection and returns the response.
+        Raises urllib2.HTTPError for error statuses, like urllib2 does.  If
+        given a timings dict, records how long each phase took in it."""
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        key = (scheme, netloc)
+        headers = dict(headers or {})
+
+        # Plain HTTP proxies expect the absolute URL in the request line
+        selector = path or '/'
+        if query:
+            selector += '?' + query
+        proxy = self._proxy(scheme, netloc)
+        if proxy and scheme == 'http':
+            selector = scheme + '://' + netloc + selector
+            if proxy[2]:
+                headers['Proxy-Authorization'] = proxy[2]
+
+        # A pooled connection may have been closed by the server while it
+        # sat idle, in which case the request is retried on a new one.  It's
+        # only sent again if the server can't have acted on it: it got no
+        # response at all, or it's safe to repeat.
+        while True:
+            conn, reused = self._get_conn(key, proxy)
+            try:
+                if timings is None:
+                    conn.request(method, selector, body, headers)
+                    resp = conn.getresponse()
+                else:
+                    resp = self._timed_request(conn, method, selector, body,
+                                               headers, timings)
+                resp = _PooledResponse(self, key, conn, resp)
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not reused or not (_is_idempotent(method, url)
+                                      or _is_unanswered(e)):
+                    raise
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+
+        # Follow redirects the same way urllib2 does
+        if resp.status in (301, 302, 303, 307) and redirects > 0:
+            location = resp.getheader('location')
+            if location:
+                resp.read()
+                resp.close()
+                if resp.status != 307:
+                    method, body = 'GET', None
+                    headers.pop('Content-Type', None)
+                    headers.pop('Content-Length', None)
+                location = urlparse.urljoin(url, location)
+                return self.urlopen(method, location, body, headers,
+                                    redirects - 1, timings)
+
+        if resp.status >= 400:
+            fp = StringIO(resp.read())
+            resp.close()
+            raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg, fp)
+        return resp
+
+    def _timed_request(self, conn, method, selector, body, headers, timings):
+        timings['connect'] = timings['tls'] = 0.0
+        if conn.sock is None:
+            started = time.time()
+            conn.connect()
+            timings['connect'] = getattr(conn, 'connect_time',
+                                         time.time() - started)
+            timings['tls'] = getattr(conn, 'tls_time', 0.0)
+        started = time.time()
+        conn.request(method, selector, body, headers)
+        timings['send'] = time.time() - started
+        started = time.time()
+        resp = conn.getresponse()
+        timings['first_byte'] = time.time() - started
+        return resp
+
+    def clear(self):
+        """ Closes all idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn, _ in conns:
+                conn.close()
+
+    def _get_conn(self, key, proxy):
+        now = time.time()
+        with self._lock:
+            conns = self._idle.get(key)
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._new_conn(key[0], key[1], proxy), False
+
+    def _put_conn(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def _new_conn(self, scheme, netloc, proxy):
+        timeout = self.timeout
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        if scheme == 'https':
+            if proxy:
+                conn = _HTTPSConnection(proxy[0], proxy[1],
+                                        key_file=self.key_file,
+                                        cert_file=self.cert_file,
+                                        timeout=timeout)
+                tunnel_headers = None
+                if proxy[2]:
+                    tunnel_headers = {'Proxy-Authorization': proxy[2]}
+                conn.set_tunnel(netloc, headers=tunnel_headers)
+            else:
+                conn = _HTTPSConnection(netloc, key_file=self.key_file,
+                                        cert_file=self.cert_file,
+                                        timeout=timeout)
+        elif proxy:
+            conn = httplib.HTTPConnection(proxy[0], proxy[1], timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=timeout)
+        return conn
+
+    def _proxy(self, scheme, netloc):
+        """ Returns the (host, port, Proxy-Authorization header) of the proxy
+        for a host, or None to connect directly.  Without a proxy_host, the
+        http_proxy and https_proxy environment variables (and no_proxy) are
+        used, as urllib2 uses them. """
+        if self.proxy_host:
+            return self.proxy_host, self.proxy_port, None
+        proxy_url = urllib.getproxies().get(scheme)
+        if not proxy_url or urllib.proxy_bypass(netloc.split(':')[0]):
+            return None
+        if '://' not in proxy_url:
+            proxy_url = 'http://' + proxy_url
+        parts = urlparse.urlsplit(proxy_url)
+        auth = None
+        if parts.username is not None:
+            credentials = urllib.unquote(parts.username) + ':' \
+                + urllib.unquote(parts.password or '')
+            auth = 'Basic ' + base64.b64encode(credentials)
+        return parts.hostname, parts.port, auth
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """ An HTTPSConnection that times its TCP connect and TLS handshake. """
+
+    connect_time = tls_time = 0.0
+
+    def connect(self):
+        started = time.time()
+        httplib.HTTPConnection.connect(self)
+        self.connect_time = time.time() - started
+        started = time.time()
+        if hasattr(self, '_context'):
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=self._tunnel_host or self.host)
+        else:
+            import ssl
+            self.sock = ssl.wrap_socket(self.sock, self.key_file,
+                                        self.cert_file)
+        self.tls_time = time.time() - started
+
+
+class _PooledResponse(object):
+    """ An HTTP response that hands its connection back to the pool once it
+    has been read to the end. """
+
+    def __init__(self, pool, key, conn, resp):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self.status = resp.status
+        self.reason = resp.reason
+        self.msg = resp.msg
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def info(self):
+        return self._resp.msg
+
+    def getheader(self, name, default=None):
+        return self._resp.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self._resp.read(amt)
+        self.bytes_received += len(data)
+        if self._resp.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._resp.isclosed():
+            self._release()
+        else:
+            # Unread data is left on the socket, so it can't be reused
+            self._resp.close()
+            self._conn.close()
+            self._conn = None
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._resp.will_close:
+            conn.close()
+        else:
+            self._pool._put_conn(self._key, conn)
+
+class _ReplayedResponse(object):
+    """ A response read from memory, with the interface of a
+    _PooledResponse. """
+
+    def __init__(self, status, reason, msg, data):
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self._data = StringIO(data)
+
+    def info(self):
+        return self.msg
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self._data.read() if amt is None else self._data.read(amt)
+        self.bytes_received += len(data)
+        return data
+
+    def close(self):
+        pass
+
+def _iter_response(resp):
+    """ Yields the body of a response a block at a time as it arrives,
+    decompressing it on the fly if it's gzip encoded. """
+    decoder = None
+    if resp.info().get('Content-Encoding') == 'gzip':
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        while True:
+            chunk = resp.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            if decoder:
+                chunk = decoder.decompress(chunk)
+            if chunk:
+                resp.bytes_decoded += len(chunk)
+                yield chunk
+        if decoder:
+            chunk = decoder.flush()
+            if chunk:
+                resp.bytes_decoded += len(chunk)
+                yield chunk
+    finally:
+        resp.close()
+
+def _read_response(resp):
+    """ Reads the whole (decompressed) body of a response.  The body is
+    still held in memory (once, decompressed), as json can only parse a
+    whole document and get(try_json=False) returns it as a string; only
+    download writes it out a block at a time. """
+    return ''.join(_iter_response(resp))
+
+def _is_unanswered(error):
+    """ Returns true if a request failed because the connection was closed
+    (rather than reset) before any of the response arrived, as a server
+    closes a keep-alive connection it has kept open for long enough. """
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line in _NO_STATUS_LINES
+
+    # Over SSL, the SSL layer sees the end of the connection first
+    import ssl
+    return isinstance(error, ssl.SSLError) and 'EOF' in str(error).upper()
+
+def _is_idempotent(method, url):
+    """ Returns true if the request can safely be sent again. """
+    if method == 'GET':
+        return True
+    operation = urlparse.urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+    return operation.lower() not in _WRITE_OPERATIONS
+
+def _redact(text):
+    """ Returns a URL or request body with its tokens and passwords
+    redacted. """
+    if not text:
+        return text
+    return _SECRET_PARAM_RE.sub(r'\1' + _REDACTED, text)
+
+def _redact_body(data, msg):
+    """ Returns a response body with its tokens and passwords redacted. """
+    gzipped = msg.get('Content-Encoding') == 'gzip'
+    text = zlib.decompress(data, 16 + zlib.MAX_WBITS) if gzipped else data
+    redacted = _SECRET_JSON_RE.sub(r'\1' + _REDACTED, _redact(text))
+    if redacted == text:
+        return data
+    return _gzip(redacted) if gzipped else redacted
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _request_key(method, url, body=None):
+    """ Returns what a recorded request is matched on: its method, path and
+    sorted parameters (except secrets and the referer). """
+    _, _, path, query, _ = urlparse.urlsplit(url)
+    params = urlparse.parse_qsl(query, True)
+    if body and isinstance(body, basestring):
+        params += urlparse.parse_qsl(body, True)
+    params = sorted(param for param in params
+                    if param[0] not in _UNMATCHED_PARAMS)
+    return method, path, tuple(params)
+
+def _replay_response(url, record, data):
+    """ Returns a recorded response, or raises it as urllib2.HTTPError if
+    its status is an error, as _ConnectionPool.urlopen does. """
+    msg = httplib.HTTPMessage(StringIO(record['headers']))
+    if record['status'] >= 400:
+        raise urllib2.HTTPError(url, record['status'], record['reason'], msg,
+                                StringIO(data))
+    return _ReplayedResponse(record['status'], record['reason'], msg, data)
+
+def _endpoint_class(method, url, body=None):
+    """ Returns the RateLimiter class of a request. """
+    path = urlparse.urlsplit(url).path.rstrip('/')
+    operation = path.rsplit('/', 1)[-1].lower()
+    if operation in _UPLOAD_OPERATIONS or isinstance(body, _MultipartBody):
+        return 'upload'
+    if path.endswith(_SEARCH_PATHS):
+        return 'search'
+    if method == 'POST' and operation in _WRITE_OPERATIONS:
+        return 'write'
+    return 'default'
+
+def _retry_after(error):
+    """ Returns the seconds to wait asked for by an HTTPError's Retry-After
+    header (either seconds or an HTTP date), or None. """
+    value = error.info().getheader('Retry-After') if error.info() else None
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        import email.utils
+        date = email.utils.parsedate_tz(value)
+        if date:
+            return max(0, email.utils.mktime_tz(date) - time.time())
+    return None
+
+def _path_template(url):
+    """ Returns the REST path of a URL with the names and ids in it replaced
+    by placeholders, like community/users/{user}. """
+    path = urlparse.urlsplit(url).path
+    if '/sharing/rest/' in path:
+        path = path.split('/sharing/rest/', 1)[1]
+    parts = [part for part in path.split('/') if part]
+    template = []
+    for i, part in enumerate(parts):
+        prev = parts[i - 1] if i else None
+        if prev == 'users':
+            part = '{user}'
+        elif prev == 'groups':
+            part = '{group}'
+        elif prev == 'items':
+            part = '{item}'
+        elif prev == 'portals' and part != 'self':
+            part = '{portal}'
+        elif _ID_RE.match(part):
+            part = '{folder}' if template and template[-1] == '{user}' \
+                else '{id}'
+        template.append(part)
+    return '/'.join(template) or '/'
+
+_ID_RE = re.compile('^[0-9a-f]{32}$')
+
+class _Metrics(object):
+    """ Counts, latencies and sizes of requests, by REST path template. """
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, url):
+        template = _path_template(url)
+        endpoint = self._endpoints.get(template)
+        if endpoint is None:
+            endpoint = self._endpoints[template] = {
+                'count': 0, 'errors': 0, 'retries': 0, 'relogins': 0,
+                'latency_sum': 0.0, 'latency_max': 0.0,
+                'buckets': [0] * (len(_LATENCY_BUCKETS) + 1),
+                'bytes_sent': 0, 'bytes_received': 0, 'bytes_decoded': 0 }
+        return endpoint
+
+    def record(self, url, latency, sent=0, received=0, decoded=0, retries=0,
+               error=False):
+        with self._lock:
+            endpoint = self._endpoint(url)
+            endpoint['count'] += 1
+            endpoint['errors'] += 1 if error else 0
+            endpoint['retries'] += retries
+            endpoint['latency_sum'] += latency
+            endpoint['latency_max'] = max(endpoint['latency_max'], latency)
+            endpoint['buckets'][bisect.bisect_left(_LATENCY_BUCKETS,
+                                                   latency)] += 1
+            endpoint['bytes_sent'] += sent
+            endpoint['bytes_received'] += received
+            endpoint['bytes_decoded'] += decoded
+
+    def record_relogin(self, url):
+        with self._lock:
+            self._endpoint(url)['relogins'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = copy.deepcopy(self._endpoints)
+        for endpoint in stats.itervalues():
+            buckets = endpoint.pop('buckets')
+            endpoint['latency_mean'] = endpoint['latency_sum'] \
+                / max(1, endpoint['count'])
+            endpoint['latency_histogram'] = zip(_LATENCY_BUCKETS
+                                                + (float('inf'),), buckets)
+            endpoint['gzip_ratio'] = float(endpoint['bytes_decoded']) \
+                / endpoint['bytes_received'] if endpoint['bytes_received'] \
+                else None
+        return stats
+
+    def write_prometheus(self, filepath):
+        stats = sorted(self.stats().iteritems())
+        labels = dict((path, 'path="%s"' % path.replace('"', '\\"'))
+                      for path, _ in stats)
+        lines = []
+        for name, key, helptext in _PROMETHEUS_COUNTERS:
+            lines.append('# HELP portalpy_%s %s' % (name, helptext))
+            lines.append('# TYPE portalpy_%s counter' % name)
+            lines.extend('portalpy_%s{%s} %d'
+                         % (name, labels[path], endpoint[key])
+                         for path, endpoint in stats)
+
+        name = 'portalpy_request_duration_seconds'
+        lines.append('# HELP %s Request latency, including retries.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for path, endpoint in stats:
+            total = 0
+            for bound, count in endpoint['latency_histogram']:
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('%s_bucket{%s,le="%s"} %d'
+                             % (name, labels[path], le, total))
+            lines.append('%s_sum{%s} %r' % (name, labels[path],
+                                            endpoint['latency_sum']))
+            lines.append('%s_count{%s} %d' % (name, labels[path],
+                                              endpoint['count']))
+
+        # Readers (like node_exporter) never see a partial file, and may
+        # run as other users
+        _write_file(filepath, '\n'.join(lines) + '\n', 0644)
+
+class _TokenBucket(object):
+    """ Lets requests through at rate per second on average, in bursts of
+    up to burst.  adapt() tunes the rate (up to the initial one) to the
+    response times seen, increasing it additively and cutting it
+    multiplicatively. """
+
+    def __init__(self, rate, burst):
+        self.rate = self.max_rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._latency = None
+        self._baseline = None
+        self._last_cut = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Take a token, going into debt if there are none, and wait for the
+        # debt to be paid off, so waiting requests go in order
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens
+                               + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def adapt(self, latency, overloaded, tolerance, target):
+        with self._lock:
+            if self._latency is None:
+                self._latency = self._baseline = latency
+            # Compare a fast moving average of the latency with a slow one,
+            # so a rise is noticed but a new normal is accepted over time
+            self._latency = 0.8 * self._latency + 0.2 * latency
+            self._baseline = 0.99 * self._baseline + 0.01 * latency
+            limit = target or self._baseline * tolerance
+            now = time.time()
+            if overloaded or self._latency > limit:
+                # Cut at most once per round trip, as the requests already
+                # in flight were sent at the old rate
+                if now - self._last_cut > max(1.0, self._latency):
+                    self._last_cut = now
+                    self.rate = max(self.max_rate / 100, self.rate * 0.7)
+                    _log.debug('Slowing requests to %.2f per second'
+                               % self.rate)
+            else:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+class _CircuitBreaker(object):
+    """ Counts the requests to a host that failed in a row.  Once there have been
+    threshold of them, allow() returns false for reset_timeout seconds, and
+    then true for one trial request at a time until one succeeds. """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if time.time() - self._opened >= self.reset_timeout:
+                self._opened = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                if self._opened is None:
+                    _log.warning('Too many failed requests in a row, pausing '
+                                 'requests for %d seconds' % self.reset_timeout)
+                self._opened = time.time()
+
+# Stacks kept per thread (like a Tracer's open spans), which the threads
+# that portalpy starts to do part of a call take on from its caller (see
+# _in_caller_state)
+_caller_state = threading.local()
+
+def _in_caller_state(func):
+    """ Returns func wrapped to run, on whichever thread calls it, with
+    copies of the stacks the calling thread has in _caller_state now. """
+    state = dict((key, list(stack))
+                 for key, stack in _caller_state.__dict__.iteritems())
+    if not state:
+        return func
+    def call(*args, **kwargs):
+        saved = _caller_state.__dict__.copy()
+        _caller_state.__dict__.update((key, list(stack))
+                                      for key, stack in state.iteritems())
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _caller_state.__dict__.clear()
+            _caller_state.__dict__.update(saved)
+    return call
+
+
+class _BackgroundCall(object):
+    """ Calls a function on a daemon thread; result() waits for it to return
+    and returns its value (or re-raises its error). """
+
+    def __init__(self, func, *args):
+        self._value = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        args=(_in_caller_state(func), args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._value = func(*args)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def result(self):
+        self._thread.join()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+
+class _Future(object):
+    """ The pending result of a call submitted to a _WorkerPool. """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._value = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Waits for the call and returns its value (or re-raises its
+        error).  Raises RuntimeError after timeout seconds, if given. """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for the result')
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+
+    def exception(self, timeout=None):
+        """ Waits for the call and returns its error, or None. """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for the result')
+        return self._error[1] if self._error else None
+
+    def add_done_callback(self, func):
+        """ Calls func(future) when the call is done (now, if it is). """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _set(self, value=None, error=None):
+        with self._lock:
+            self._value = value
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                _log.exception('Error in future callback')
+
+
+class _WorkerPool(object):
+    """ Runs submitted calls on up to `workers` daemon threads, started as
+    they are needed. """
+
+    def __init__(self, workers):
+        self._workers = max(1, workers)
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, func, *args, **kwargs):
+        future = _Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The worker pool has been shut down')
+            self._queue.put((future, _in_caller_state(func), args, kwargs))
+            self._pending += 1
+            if self._pending > len(self._threads) \
+                    and len(self._threads) < self._workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            try:
+                future._set(func(*args, **kwargs))
+            except Exception:
+                future._set(error=sys.exc_info())
+            with self._lock:
+                self._pending -= 1
+
+
+def _parallel_map(func, items, workers):
+    """ Calls func on each item on up to `workers` threads and returns the
+    results in the order of items. The first error raised is re-raised. """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    func = _in_caller_state(func)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for index_item in enumerate(items):
+        queue.put(index_item)
+
+    def worker():
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class _FileSegment(object):
+    """ A file (or a byte range of one) to be streamed into a request body. """
+
+    def __init__(self, filepath, offset=0, length=None):
+        self.filepath = filepath
+        self.offset = offset
+        if length is None:
+            length = os.path.getsize(filepath) - offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+class _MultipartBody(object):
+    """ A read-only, file-like request body made of byte strings and file
+    segments. Files are read a block at a time as the body is sent, so
+    memory use doesn't grow with the size of the upload. """
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._length = sum(len(part) for part in parts)
+        self._file = None
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self.read(_CHUNK_SIZE), ''))
+        while self._index < len(self._parts):
+            part = self._parts[self._index]
+            remaining = min(size, len(part) - self._pos)
+            if isinstance(part, _FileSegment):
+                if self._file is None:
+                    self._file = open(part.filepath, 'rb')
+                    self._file.seek(part.offset)
+                data = self._file.read(remaining)
+            else:
+                data = part[self._pos:self._pos + remaining]
+            if data:
+                self._pos += len(data)
+                return data
+            self._next_part()
+        return ''
+
+    def seek(self, pos):
+        """ Rewinds the body so it can be sent again (only 0 is supported). """
+        if pos != 0:
+            raise ValueError('A multipart body can only be rewound to 0')
+        self.close()
+        self._index = 0
+        self._pos = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _next_part(self):
+        self.close()
+        self._index += 1
+        self._pos = 0
+
+
+def _utf8(text):
+    """ Returns text as a byte string, encoding it as UTF-8 if it's unicode
+    (so its length is its length in bytes). """
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def _write_file(filepath, data, mode=None):
+    """ Writes data to a new file and moves it into place, so neither
+    readers nor a crash part way through ever see a partial file. The file
+    is only readable by its owner, unless given another mode. """
+    import tempfile
+    fd, tmppath = tempfile.mkstemp(prefix=os.path.basename(filepath) + '.',
+                                   dir=os.path.dirname(filepath) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmppath, mode)
+        # os.rename doesn't replace an existing file on Windows
+        if os.name == 'nt' and os.path.exists(filepath):
+            os.remove(filepath)
+        os.rename(tmppath, filepath)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+_normalized_urls = {}
+_token_url_templates = {}
 
 def _normalize_url(url, charset='utf-8'):
+    """ Normalizes a URL, remembering the result, as the same few URLs are
+    normalized over and over. """
+    key = (url, charset)
+    normalized = _normalized_urls.get(key)
+    if normalized is None:
+        if len(_normalized_urls) >= _URL_CACHE_SIZE:
+            _normalized_urls.clear()
+        normalized = _normalize_url_uncached(url, charset)
+        _normalized_urls[key] = normalized
+    return normalized
+
+def _normalize_url_uncached(url, charset='utf-8'):
     """ Normalizes a URL. Based on http://code.google.com/p/url-normalize."""
     def _clean(string):
         string = unicode(urllib.unquote(string), 'utf-8', 'replace')
@@ -2210,6 +4685,59 @@ def _normalize_url(url, charset='utf-8'):
         path += "#"
     return urlparse.urlunsplit((scheme, auth, path, query, fragment))
 
+def _url_with_token(url, token):
+    """ Returns the URL with its token parameter set to token (or added),
+    parsing and rebuilding its query string. """
+
+    # Parse the URL and query string
+    urlparts = urlparse.urlparse(url)
+    qs_list = urlparse.parse_qsl(urlparts.query)
+
+    # Update the token query string parameter
+    replaced_token = False
+    new_qs_list = []
+    for qs_param in qs_list:
+        if qs_param[0] == 'token':
+            qs_param = ('token', token)
+            replaced_token = True
+        new_qs_list.append(qs_param)
+    if not replaced_token:
+        new_qs_list.append(('token', token))
+
+    # Rebuild the URL from parts and return it
+    return urlparse.urlunparse((urlparts.scheme, urlparts.netloc,
+                                urlparts.path, urlparts.params,
+                                urllib.urlencode(new_qs_list),
+                                urlparts.fragment))
+
+def _copy_json(value):
+    """ Returns a deep copy of decoded JSON. It's several times quicker than
+    copy.deepcopy, as scalars are copied along with their dict or list, and
+    only dicts and lists are looked into; anything else is deep copied. """
+    kind = type(value)
+    if kind is dict:
+        copied = value.copy()
+        for key, item in value.iteritems():
+            if type(item) not in _JSON_SCALAR_TYPES:
+                copied[key] = _copy_json(item)
+        return copied
+    if kind is list:
+        copied = value[:]
+        for index, item in enumerate(value):
+            if type(item) not in _JSON_SCALAR_TYPES:
+                copied[index] = _copy_json(item)
+        return copied
+    if kind in _JSON_SCALAR_TYPES:
+        return value
+    return copy.deepcopy(value)
+
+_JSON_SCALAR_TYPES = frozenset([str, unicode, int, long, float, bool,
+                                type(None)])
+
+def _modified_query(since):
+    """ Returns a query for things modified since a time (ms since 1970). """
+    return 'modified:[%019d TO %019d]' % (since, int(time.time() * 1000))
+
 def _parse_hostname(url, include_port=False):
     """ Parses the hostname out of a URL."""
     if url:
@@ -2250,12 +4778,48 @@ def _unpack_obj(obj, key=None, flatten=False):
 
     return value
 
+def set_json_backend(backend):
+    """ Sets the module used to decode JSON responses, for example
+    simplejson, which is faster than the standard library's json (the
+    default).  backend is the module or its name, and must have a loads
+    function that takes an object_pairs_hook, like json's.  Note that
+    simplejson returns ASCII strings as str rather than unicode when the
+    connection doesn't ensure_ascii. """
+    global _json_backend
+    if isinstance(backend, basestring):
+        backend = importlib.import_module(backend)
+    _json_backend = backend
+
+def _decode_json(text, ensure_ascii=True):
+    """ Parses JSON, converting strings to ascii (dropping other characters)
+    as it goes if ensure_ascii is true, rather than in a second pass. """
+    if not ensure_ascii:
+        return _json_backend.loads(text)
+    data = _json_backend.loads(text, object_pairs_hook=_ascii_dict)
+    if isinstance(data, dict):
+        return data
+    return _ascii_value(data)
+
+def _ascii_dict(pairs):
+    # Nested objects were converted on the way up, so only strings and
+    # lists are left to convert
+    return dict((_ascii_value(k), _ascii_value(v)) for k, v in pairs)
+
+def _ascii_value(value):
+    if isinstance(value, unicode):
+        return value.encode('ascii', 'ignore')
+    if isinstance(value, list):
+        return [_ascii_value(v) for v in value]
+    if isinstance(value, str):
+        return _remove_non_ascii(value)
+    return value
+
 def _unicode_to_ascii(data):
     """ Converts strings and collections of strings from unicode to ascii. """
     if isinstance(data, str):
         return _remove_non_ascii(data)
     if isinstance(data, unicode):
-        return _remove_non_ascii(str(data.encode('utf8')))
+        return data.encode('ascii', 'ignore')
     elif isinstance(data, collections.Mapping):
         return dict(map(_unicode_to_ascii, data.iteritems()))
     elif isinstance(data, collections.Iterable):
@@ -2263,8 +4827,10 @@ def _unicode_to_ascii(data):
     else:
         return data
 
+_NON_ASCII = ''.join(map(chr, range(128, 256)))
+
 def _remove_non_ascii(s):
-    return ''.join(i for i in s if ord(i) < 128)
+    return s.translate(None, _NON_ASCII)
 
 def _tostr(obj):
     if not obj:
@@ -2273,20 +4839,3 @@ def _tostr(obj):
         return ', '.join(map(_tostr, obj))
     return str(obj)
 
-
-
-
-# This function is a workaround to deal with what's typically described as a
-# problem with the web server closing a connection. This is problem
-# experienced with www.arcgis.com (first encountered 12/13/2012). The problem
-# and workaround is described here:
-# http://bobrochel.blogspot.com/2010/11/bad-servers-chunked-encoding-and.html
-def _patch_http_response_read(func):
-    def inner(*args):
-        try:
-            return func(*args)
-        except httplib.IncompleteRead, e:
-            return e.partial
-
-    return inner
-httplib.HTTPResponse.read = _patch_http_response_read(httplib.HTTPResponse.read)
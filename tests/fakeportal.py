@@ -0,0 +1,525 @@
+""" A stand-in for the Portal for ArcGIS REST API, for testing and benchmarking
+portalpy without a real portal (or a network).
+
+FakePortal serves generateToken, the version, portals/self, search, the
+community user and group endpoints, org users and item uploads (including
+multipart uploads) from generated data, over HTTPS on a local port.  It can
+be slowed down (latency), made to return smaller pages (page_size), to revoke
+its tokens every so many requests, and to fail requests on purpose (inject).
+
+Example - run a test against a fake portal
+
+    import ssl
+    ssl._create_default_https_context = ssl._create_unverified_context
+
+    fake = fakeportal.FakePortal(users=500, items=2000, latency=0.01)
+    fake.start()
+    portal = portalpy.Portal(fake.url, fake.username, fake.password)
+    ...
+    fake.stop()
+
+It uses a self-signed certificate (fakeportal.pem), so clients must not
+verify certificates, as above.  Run this module to serve a fake portal until
+interrupted (python fakeportal.py --help).
+"""
+
+import BaseHTTPServer
+import collections
+import gzip
+import hashlib
+import json
+import os
+import re
+import socket
+import SocketServer
+import ssl
+import struct
+import threading
+import time
+import urlparse
+from cStringIO import StringIO
+
+
+CERTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fakeportal.pem')
+
+# The most results a search can page through, as on a real portal
+SEARCH_RESULT_LIMIT = 10000
+
+# Faults that inject() accepts, other than HTTP status codes
+FAULTS = ('error', 'truncate', 'reset', 'abort')
+
+_BASE_TIME = 1388534400000   # 1 January 2014, in milliseconds
+_RANGE_RE = re.compile(r'(created|modified):\[(\d+) TO (\d+)\]')
+_OWNER_RE = re.compile(r'owner:(\S+)')
+_BOUNDARY_RE = re.compile(r'boundary=(\S+)')
+_NAME_RE = re.compile(r'name="([^"]*)"')
+
+
+class FakePortal(object):
+    """ A fake portal with generated users, groups and items, served from a
+    background thread. """
+
+    def __init__(self, users=100, groups=20, items=500, latency=0,
+                 page_size=100, token_lifetime=60, revoke_every=None,
+                 username='admin', password='admin', version='5.1',
+                 clock_skew=0, port=0):
+        self.latency = latency
+        self.page_size = page_size
+        self.token_lifetime = token_lifetime
+        self.clock_skew = clock_skew
+        self.revoke_every = revoke_every
+        self.username = username
+        self.password = password
+        self.version = version
+        self.port = port
+
+        self.users = [_make_user(i) for i in range(users)]
+        self.users.insert(0, _make_user(0, username, 'org_admin'))
+        self._users_by_name = dict((u['username'], u) for u in self.users)
+        self.groups = [_make_group(i, self.users) for i in range(groups)]
+        self._groups_by_id = dict((g['id'], g) for g in self.groups)
+        self.items = [_make_item(i, self.users) for i in range(items)]
+
+        # What the fake has seen (see also reset_counters)
+        self.requests = collections.Counter()
+        self.tokens_issued = 0
+        self.bytes_received = 0
+        self.parts = []
+
+        self._tokens = {}
+        self._faults = []
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        """ The URL to pass to portalpy.Portal. """
+        return 'https://127.0.0.1:%d/arcgis' % self._server.server_port
+
+    def start(self):
+        """ Starts serving on a background thread. """
+        self._server = _Server(('127.0.0.1', self.port), _Handler)
+        self._server.portal = self
+        self._server.handlers = {}
+        self._server.aborted = set()
+        self._server.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self._server.context.load_cert_chain(CERTFILE)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """ Stops serving, and closes the connections clients kept open. """
+        self._server.shutdown()
+        self._server.server_close()
+        self._server.close_connections()
+
+    def inject(self, fault, path='', times=1, retry_after=None):
+        """ Makes the next `times` requests whose path contains `path` fail.
+
+        fault is 498 (an invalid token error, as JSON), another HTTP status
+        code (429, 500, 502, 503, 504, ...), 'error' (a JSON error response,
+        as for a bad request), 'truncate' (the response is cut short),
+        'reset' (the connection is closed without a response) or 'abort'
+        (the connection is reset, with a TCP RST, without a response).
+        A 429 or 503 response carries retry_after in a Retry-After header,
+        if given. """
+        if not isinstance(fault, int) and fault not in FAULTS:
+            raise ValueError('Unknown fault: ' + str(fault))
+        with self._lock:
+            self._faults.append([path, fault, times, retry_after])
+
+    def revoke_tokens(self):
+        """ Makes every token issued so far invalid. """
+        with self._lock:
+            self._tokens.clear()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.tokens_issued = 0
+            self.bytes_received = 0
+            self.parts = []
+
+    # Request handling, called by _Handler
+
+    def _take_fault(self, path):
+        with self._lock:
+            for fault in self._faults:
+                if fault[0] in path:
+                    fault[2] -= 1
+                    if not fault[2]:
+                        self._faults.remove(fault)
+                    return fault[1], fault[3]
+        return None, None
+
+    def _check_token(self, token):
+        with self._lock:
+            count = sum(self.requests.itervalues())
+            if self.revoke_every and count % self.revoke_every == 0:
+                self._tokens.clear()
+            expires = self._tokens.get(token)
+        return expires is not None and expires > time.time()
+
+    def _generate_token(self, form):
+        if form.get('username') != self.username \
+                or form.get('password') != self.password:
+            return _error(400, 'Unable to generate token.',
+                          ['Invalid username or password.'])
+        lifetime = min(int(form.get('expiration') or 60), self.token_lifetime)
+        expires = time.time() + lifetime * 60
+        with self._lock:
+            self.tokens_issued += 1
+            token = hashlib.sha1('%d-%f' % (self.tokens_issued,
+                                            time.time())).hexdigest()
+            self._tokens[token] = expires
+        # Expiry times are given by the fake's clock, clock_skew seconds
+        # behind the client's
+        return { 'token': token, 'ssl': False,
+                 'expires': int((expires - self.clock_skew) * 1000) }
+
+    def _properties(self):
+        return { 'id': 'fakeorg', 'name': 'Fake Portal', 'urlKey': 'fake',
+                 'portalName': 'Portal for ArcGIS', 'portalMode': 'singletenant',
+                 'isPortal': True, 'allSSL': False, 'supportsOAuth': True,
+                 'currentVersion': self.version }
+
+    def _page(self, records, form, key='results'):
+        start = int(form.get('start') or 1)
+        num = min(int(form.get('num') or 10), self.page_size)
+        total = len(records)
+        page = records[start - 1:min(start - 1 + num, SEARCH_RESULT_LIMIT)]
+        end = start - 1 + len(page)
+        next_start = end + 1 if end < min(total, SEARCH_RESULT_LIMIT) else -1
+        return { 'total': total, 'start': start, 'num': len(page),
+                 'nextStart': next_start, key: page }
+
+    def _search(self, records, q):
+        q = q or ''
+        for match in _RANGE_RE.finditer(q):
+            field, low, high = match.group(1), int(match.group(2)), \
+                int(match.group(3))
+            records = [r for r in records if low <= r[field] <= high]
+        match = _OWNER_RE.search(q)
+        if match:
+            records = [r for r in records if r.get('owner') == match.group(1)]
+        return records
+
+    def _sorted(self, records, form):
+        field = form.get('sortField')
+        if field:
+            records = sorted(records, key=lambda r: r.get(field),
+                             reverse=form.get('sortOrder') == 'desc')
+        return records
+
+    def _handle(self, path, form, body_size):
+        """ Returns the JSON response for a REST request. """
+        parts = path.split('/')
+        if path == '':
+            return { 'currentVersion': self.version }
+        if path == 'portals/self':
+            return self._properties()
+        if path == 'portals/self/users':
+            return self._page(self.users, form, 'users')
+        if path == 'portals/self/invitations':
+            return self._page([], form, 'invitations')
+        if path == 'search':
+            items = self._search(self.items, form.get('q'))
+            return self._page(self._sorted(items, form), form)
+        if path == 'community/users':
+            users = self._search(self.users, form.get('q'))
+            return self._page(self._sorted(users, form), form)
+        if path == 'community/groups':
+            groups = self._search(self.groups, form.get('q'))
+            return self._page(self._sorted(groups, form), form)
+        if parts[:2] == ['community', 'users'] and len(parts) == 3:
+            user = self._users_by_name.get(parts[2])
+            if not user:
+                return _error(400, 'User not found', [])
+            return user
+        if parts[:2] == ['community', 'groups'] and len(parts) >= 3:
+            group = self._groups_by_id.get(parts[2])
+            if not group:
+                return _error(400, 'Group does not exist or is inaccessible.',
+                              [])
+            if len(parts) == 3:
+                return group
+            if parts[3] == 'users':
+                return { 'owner': group['owner'], 'admins': [group['owner']],
+                         'users': [u['username'] for u in self.users[:10]] }
+        if parts[:2] == ['content', 'users']:
+            return self._content(parts, form, body_size)
+        return { 'success': True }
+
+    def _content(self, parts, form, body_size):
+        operation = parts[-1]
+        if len(parts) == 3:
+            return { 'username': parts[2], 'folders': [], 'items': [] }
+        if operation == 'addItem':
+            with self._lock:
+                item_id = hashlib.md5('upload-%d' % len(self._uploads)) \
+                    .hexdigest()
+                self._uploads[item_id] = body_size
+            return { 'success': True, 'id': item_id, 'folder': None }
+        if operation == 'addPart':
+            with self._lock:
+                self.parts.append((int(form.get('partNum', 0)), body_size))
+            return { 'success': True }
+        if operation == 'status':
+            return { 'status': 'completed', 'statusMessage': 'completed',
+                     'itemId': parts[-2] }
+        return { 'success': True, 'id': parts[-2] }
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def finish_request(self, request, client_address):
+        # The TLS handshake is done on the request's thread, not the
+        # accepting one, so slow handshakes don't hold up other clients
+        try:
+            request = self.context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, socket.error):
+            return
+        BaseHTTPServer.HTTPServer.finish_request(self, request,
+                                                 client_address)
+
+    def process_request_thread(self, request, client_address):
+        # The threads are tracked, so stop() can close their connections
+        # and wait for them to finish
+        thread = threading.current_thread()
+        with self.portal._lock:
+            self.handlers[thread] = request
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            with self.portal._lock:
+                del self.handlers[thread]
+
+    def shutdown_request(self, request):
+        # Aborted connections are closed without a FIN first, so (with
+        # SO_LINGER set) the client gets a reset
+        with self.portal._lock:
+            aborted = request.fileno() in self.aborted
+            self.aborted.discard(request.fileno())
+        if aborted:
+            self.close_request(request)
+        else:
+            BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self, timeout=1):
+        with self.portal._lock:
+            handlers = self.handlers.items()
+        for thread, connection in handlers:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for thread, connection in handlers:
+            thread.join(timeout)
+
+    def handle_error(self, request, client_address):
+        # Clients closing their connections aren't errors
+        pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._respond(urlparse.urlsplit(self.path).query, 0)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            boundary = _BOUNDARY_RE.search(content_type).group(1)
+            form = _read_multipart(self.rfile, length, boundary)
+        else:
+            form = urlparse.parse_qsl(self.rfile.read(length))
+        self._respond(form, length)
+
+    def _respond(self, form, body_size):
+        portal = self.server.portal
+        if isinstance(form, basestring):
+            form = urlparse.parse_qsl(form)
+        form = dict(form)
+        path = urlparse.urlsplit(self.path).path
+        path = path.split('/sharing/rest/', 1)[-1].strip('/') \
+            if '/sharing/rest' in path else path.strip('/')
+        if path == 'arcgis/sharing/rest':
+            path = ''
+        with portal._lock:
+            portal.requests[_template(path)] += 1
+            portal.bytes_received += body_size
+
+        if portal.latency:
+            time.sleep(portal.latency)
+
+        fault, retry_after = portal._take_fault(path)
+        if fault == 'reset':
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if fault == 'abort':
+            self.close_connection = 1
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            with portal._lock:
+                self.server.aborted.add(self.connection.fileno())
+            return
+        if fault == 498:
+            return self._send_json(_error(498, 'Invalid token.', []))
+        if fault == 'error':
+            return self._send_json(_error(400, 'Fault injected', []))
+        if fault and fault != 'truncate':
+            headers = {}
+            if retry_after is not None:
+                headers['Retry-After'] = str(retry_after)
+            return self._send_body(fault, 'Fault injected', 'text/plain',
+                                   headers)
+
+        if path == 'generateToken':
+            resp = portal._generate_token(form)
+        elif form.get('token') and not portal._check_token(form['token']):
+            resp = _error(498, 'Invalid token.', [])
+        else:
+            resp = portal._handle(path, form, body_size)
+        self._send_json(resp, fault == 'truncate')
+
+    def _send_json(self, obj, truncate=False):
+        body = json.dumps(obj)
+        headers = {}
+        if len(body) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            body = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        self._send_body(200, body, 'application/json', headers, truncate)
+
+    def _send_body(self, status, body, content_type, headers, truncate=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        if truncate:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        self.wfile.write(body)
+
+
+def _read_multipart(rfile, length, boundary):
+    """ Reads a multipart body, returning its small (non-file) fields.  File
+    contents are read and dropped, so big uploads don't use up memory. """
+    fields = []
+    delimiter = '--' + boundary
+    name, value, is_file, in_headers = None, [], False, False
+    remaining = length
+    while remaining > 0:
+        line = rfile.readline(min(remaining, 64 * 1024))
+        if not line:
+            break
+        remaining -= len(line)
+        if line.startswith(delimiter):
+            if name is not None and not is_file:
+                fields.append((name, ''.join(value)[:-2]))
+            name, value, is_file, in_headers = None, [], False, True
+        elif in_headers:
+            if line == '\r\n':
+                in_headers = False
+            elif line.lower().startswith('content-disposition'):
+                match = _NAME_RE.search(line)
+                name = match and match.group(1)
+                is_file = 'filename=' in line
+        elif not is_file:
+            value.append(line)
+    return fields
+
+
+def _template(path):
+    parts = path.split('/')
+    for i in range(1, len(parts)):
+        if parts[i - 1] in ('users', 'groups', 'items'):
+            parts[i] = '{' + parts[i - 1][:-1] + '}'
+    return '/'.join(parts) or '/'
+
+
+def _error(code, message, details):
+    return { 'error': { 'code': code, 'message': message, 'details': details } }
+
+
+def _make_user(i, username=None, role='org_user'):
+    username = username or 'user%05d' % i
+    return { 'username': username, 'fullName': 'User %d' % i,
+             'firstName': 'User', 'lastName': str(i),
+             'email': username + '@example.com', 'role': role,
+             'level': '2', 'orgId': 'fakeorg', 'access': 'org',
+             'description': 'A generated user.', 'tags': [],
+             'culture': 'en', 'region': 'US', 'units': 'english',
+             'thumbnail': None, 'storageUsage': 1024 * i,
+             'created': _BASE_TIME + i * 1000,
+             'modified': _BASE_TIME + i * 1000 + 500 }
+
+
+def _make_group(i, users):
+    owner = users[i % len(users)]['username']
+    return { 'id': hashlib.md5('group-%d' % i).hexdigest(),
+             'title': 'Group %d' % i, 'owner': owner, 'isInvitationOnly': False,
+             'description': 'A generated group.', 'snippet': 'Group %d' % i,
+             'tags': ['fake', 'group'], 'phone': None, 'thumbnail': None,
+             'access': 'org', 'isViewOnly': False,
+             'created': _BASE_TIME + i * 1000,
+             'modified': _BASE_TIME + i * 1000 + 500 }
+
+
+def _make_item(i, users):
+    owner = users[i % len(users)]['username']
+    return { 'id': hashlib.md5('item-%d' % i).hexdigest(), 'owner': owner,
+             'title': 'Item %d' % i, 'type': ('Web Map', 'Feature Service',
+                                               'PDF')[i % 3],
+             'typeKeywords': ['ArcGIS Online', 'Explorer Web Map', 'Map'],
+             'description': 'A generated item. ' * 5, 'snippet': 'Item %d' % i,
+             'tags': ['fake', 'item', str(i % 10)], 'thumbnail': None,
+             'extent': [[-118.5, 33.7], [-117.6, 34.4]],
+             'spatialReference': None, 'accessInformation': None,
+             'licenseInfo': None, 'culture': 'en-us', 'access': 'org',
+             'size': 4096 + i, 'numViews': i % 1000,
+             'created': _BASE_TIME + i * 1000,
+             'modified': _BASE_TIME + i * 1000 + 500 }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serves a fake portal.')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+    fake = FakePortal(args.users, args.groups, args.items, args.latency,
+                      args.page_size, port=args.port).start()
+    print 'Serving a fake portal at ' + fake.url + ' (user ' \
+        + fake.username + ', password ' + fake.password + ')'
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()